@@ -0,0 +1,405 @@
+"""Synthetic federation served to the monitors instead of the real services
+
+The data is generated from the number of sites and VMs per site, and every
+call sleeps for the given latency to mimic a remote service. All calls are
+counted by service and operation.
+"""
+
+import json
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import xmltodict
+from fedcloud_monitoring_tools.openstack_api import command_name
+from keystoneauth1.exceptions import NotFound
+
+VO = "vo.access.egi.eu"
+STATUSES = ["ACTIVE"] * 8 + ["SHUTOFF", "ERROR"]
+FLAVORS = [
+    {
+        "Name": f"m{i}.medium",
+        "ID": f"f{i}",
+        "VCPUs": 2**i,
+        "RAM": 2048 * 2**i,
+        "Disk": 20,
+    }
+    for i in range(4)
+]
+# SLAs in fedcloud_monitoring_tools/data/vos.yaml
+SLA_NAMES = ["D4SCIENCE", "WENMR", "OBSEA"]
+USERS_PER_SITE = 50
+IMAGES_PER_SITE = 20
+# items per page of the list calls, below the page size asked by the monitor
+MAX_LIMIT = 100
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.status_code = 200
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeAPIResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeKeystoneSession:
+    """Keystone session of a site, the site is taken from the auth URL"""
+
+    def __init__(self, federation, auth=None, **kwargs):
+        self.federation = federation
+        self.site = urlparse(auth.auth_url).hostname.split(".")[0].upper()
+        self.token = None
+
+    def get_token(self):
+        if self.token is None:
+            self.federation._call("keystone", "authenticate")
+            self.token = "benchmark-scoped"
+        return self.token
+
+    def get_project_id(self):
+        return f"{self.site}-project"
+
+    def get_user_id(self):
+        return "user-0"
+
+
+class FakeAdapter:
+    """Adapter of a service of a site, the calls go to the federation"""
+
+    def __init__(self, federation, session, service_type=None, **kwargs):
+        self.federation = federation
+        self.session = session
+        self.service_type = service_type
+
+    def get(self, path, params=None, **kwargs):
+        self.session.get_token()
+        return FakeAPIResponse(
+            self.federation.openstack_api(
+                self.session.site, self.service_type, "GET", path, params or {}
+            )
+        )
+
+    def delete(self, path, **kwargs):
+        self.session.get_token()
+        self.federation.openstack_api(
+            self.session.site, self.service_type, "DELETE", path, {}
+        )
+
+
+class FakeFederation:
+    """Synthetic sites, VMs, GOCDB, AppDB and accounting data"""
+
+    def __init__(self, sites=5, vms=200, latency=0.0, sla_names=SLA_NAMES):
+        self.sites = [f"SITE-{i:03d}" for i in range(sites)]
+        self.vms = vms
+        self.latency = latency
+        self.sla_names = list(sla_names)
+        self.calls = Counter()
+        self.deleted = set()
+        self._lock = threading.Lock()
+
+    def _call(self, service, operation):
+        with self._lock:
+            self.calls[(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # OpenStack, replaces fedcloudclient's fedcloud_openstack
+
+    def _server(self, site, i):
+        return {
+            "ID": f"{site}-vm-{i:05d}",
+            "Name": f"vm-{i}",
+            "Status": STATUSES[i % len(STATUSES)],
+            "Networks": {"private": [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}"]},
+            "Image Name": f"image-{i % IMAGES_PER_SITE}",
+            "Image ID": f"img-{i % IMAGES_PER_SITE}",
+            "Flavor": FLAVORS[i % len(FLAVORS)]["Name"],
+        }
+
+    def _server_show(self, site, vm_id):
+        i = int(vm_id.rsplit("-", 1)[1])
+        return {
+            "id": vm_id,
+            "created_at": f"20{20 + i % 5}-0{1 + i % 9}-01T00:00:00Z",
+            "updated": "2024-01-01T00:00:00Z",
+            "user_id": f"user-{i % USERS_PER_SITE}",
+            "security_groups": [{"name": "default"}, {"name": f"sg-{i % 3}"}],
+            "attached_volumes": [],
+            "properties": {},
+            "tags": ["keep"] if i % 10 == 1 else [],
+        }
+
+    def openstack(self, token, site, vo, command, json_output=True):
+        command = tuple(command)
+        self._call("openstack", " ".join(command_name(command) or command[:2]))
+        if command[:2] == ("server", "list"):
+            if "--changes-since" in command:
+                return 0, []
+            servers = [self._server(site, i) for i in range(self.vms)]
+            return 0, [vm for vm in servers if vm["ID"] not in self.deleted]
+        if command[:2] == ("server", "show"):
+            return 0, self._server_show(site, command[2])
+        if command[:2] == ("server", "delete"):
+            with self._lock:
+                self.deleted.add(command[2])
+            return 0, ""
+        if command[:2] == ("flavor", "list"):
+            return 0, FLAVORS
+        if command[:2] == ("image", "show"):
+            return 0, {"properties": {"os_distro": "ubuntu", "os_version": "22.04"}}
+        if command[:2] == ("user", "list"):
+            return 0, [
+                {"ID": f"user-{i}", "Name": f"user{i}@egi.eu"}
+                for i in range(USERS_PER_SITE)
+            ]
+        if command[:2] == ("quota", "show"):
+            return 0, [
+                {"Resource": "cores", "Limit": 400, "In Use": 120},
+                {"Resource": "instances", "Limit": 100, "In Use": 40},
+                {"Resource": "ram", "Limit": 1024000, "In Use": 204800},
+                {"Resource": "floating-ips", "Limit": 100, "In Use": 10},
+                {"Resource": "secgroup-rules", "Limit": 1000, "In Use": 50},
+                {"Resource": "secgroups", "Limit": 300, "In Use": 5},
+            ]
+        if command[:3] == ("security", "group", "list"):
+            return 0, [{"ID": f"sg{i}", "Name": f"sg-{i}"} for i in range(5)] + [
+                {"ID": "default", "Name": "default"}
+            ]
+        if command[:3] == ("floating", "ip", "list"):
+            return 0, [{"Floating IP Address": f"192.0.2.{i}"} for i in range(3)]
+        if command[:2] == ("volume", "list"):
+            return 0, [{"ID": f"vol{i}", "Name": "", "Size": 10} for i in range(3)]
+        return 1, f"Command not available in the benchmark: {' '.join(command)}"
+
+    # OpenStack APIs, replace the keystoneauth session and adapters used by
+    # the api backend
+
+    def keystone_session(self, auth=None, **kwargs):
+        return FakeKeystoneSession(self, auth, **kwargs)
+
+    def keystone_adapter(self, session, **kwargs):
+        return FakeAdapter(self, session, **kwargs)
+
+    def _rest_server(self, site, i):
+        server = self._server(site, i)
+        show = self._server_show(site, server["ID"])
+        return {
+            "id": server["ID"],
+            "name": server["Name"],
+            "status": server["Status"],
+            "addresses": {
+                net: [{"addr": addr} for addr in addrs]
+                for net, addrs in server["Networks"].items()
+            },
+            "image": {"id": server["Image ID"]},
+            "flavor": {"id": FLAVORS[i % len(FLAVORS)]["ID"]},
+            "created": show["created_at"],
+            "updated": show["updated"],
+            "user_id": show["user_id"],
+            "tenant_id": f"{site}-project",
+            "security_groups": show["security_groups"],
+            "os-extended-volumes:volumes_attached": [],
+            "metadata": show["properties"],
+            "tags": show["tags"],
+        }
+
+    def _rest_image(self, k):
+        return {
+            "id": f"img-{k}",
+            "name": f"image-{k}",
+            "status": "active",
+            "os_distro": "ubuntu",
+            "os_version": "22.04",
+        }
+
+    def _page(self, items, params, key):
+        """Page of the items as returned by Nova, with the link to the next one"""
+        if "marker" in params:
+            start = [item["id"] for item in items].index(params["marker"]) + 1
+            items = items[start:]
+        limit = min(int(params.get("limit", MAX_LIMIT)), MAX_LIMIT)
+        page = {key: items[:limit]}
+        if len(items) > limit:
+            page[f"{key}_links"] = [{"rel": "next", "href": ""}]
+        return page
+
+    def _quota(self, limit, in_use, used="in_use"):
+        return {"limit": limit, used: in_use, "reserved": 0}
+
+    def openstack_api(self, site, service_type, method, path, params):
+        """Response of the REST call, with the same calls as the CLI counted"""
+        parts = path.strip("/").split("/")
+        if service_type == "identity" and parts[0] == "users":
+            self._call("openstack", "user show" if len(parts) > 1 else "user list")
+            users = [
+                {"id": f"user-{i}", "name": f"user{i}@egi.eu"}
+                for i in range(USERS_PER_SITE)
+            ]
+            if len(parts) > 1:
+                return {"user": users[int(parts[1].split("-")[1])]}
+            return {"users": users}
+        if service_type == "compute" and path == "/flavors/detail":
+            self._call("openstack", "flavor list")
+            flavors = [
+                {
+                    "id": flv["ID"],
+                    "name": flv["Name"],
+                    "ram": flv["RAM"],
+                    "disk": flv["Disk"],
+                    "vcpus": flv["VCPUs"],
+                }
+                for flv in FLAVORS
+            ]
+            return {"flavors": flavors}
+        if service_type == "compute" and path == "/servers/detail":
+            self._call("openstack", "server list")
+            if "changes-since" in params:
+                return {"servers": []}
+            servers = [
+                self._rest_server(site, i)
+                for i in range(self.vms)
+                if f"{site}-vm-{i:05d}" not in self.deleted
+            ]
+            return self._page(servers, params, "servers")
+        if service_type == "compute" and parts[0] == "servers":
+            if method == "DELETE":
+                self._call("openstack", "server delete")
+                with self._lock:
+                    self.deleted.add(parts[1])
+                return {}
+            self._call("openstack", "server show")
+            i = int(parts[1].rsplit("-", 1)[1])
+            return {"server": self._rest_server(site, i)}
+        if service_type == "compute" and parts[0] == "os-quota-sets":
+            self._call("openstack", "quota show")
+            quota_set = {
+                "id": f"{site}-project",
+                "cores": self._quota(400, 120),
+                "instances": self._quota(100, 40),
+                "ram": self._quota(1024000, 204800),
+                # deprecated, the network quotas are the ones to show
+                "floating_ips": self._quota(-1, 0),
+                "security_groups": self._quota(-1, 0),
+            }
+            return {"quota_set": quota_set}
+        if service_type == "network" and parts[1] == "quotas":
+            quota = {
+                "floatingip": self._quota(100, 10, "used"),
+                "security_group": self._quota(300, 5, "used"),
+                "security_group_rule": self._quota(1000, 50, "used"),
+            }
+            return {"quota": quota}
+        if service_type == "image" and path == "/v2/images":
+            self._call("openstack", "image list")
+            images = [self._rest_image(k) for k in range(IMAGES_PER_SITE)]
+            return self._page(images, params, "images")
+        if service_type == "image" and parts[1] == "images":
+            self._call("openstack", "image show")
+            return self._rest_image(int(parts[2].split("-")[1]))
+        if service_type == "block-storage" and path == "/volumes/detail":
+            self._call("openstack", "volume list")
+            volumes = [
+                {"id": f"vol{i}", "name": "", "status": "available", "size": 10}
+                for i in range(3)
+            ]
+            return self._page(volumes, params, "volumes")
+        if service_type == "network" and parts[1] == "security-groups":
+            self._call("openstack", "security group list")
+            groups = [{"id": f"sg{i}", "name": f"sg-{i}"} for i in range(5)]
+            groups.append({"id": "default", "name": "default"})
+            return {"security_groups": groups}
+        if service_type == "network" and parts[1] == "floatingips":
+            self._call("openstack", "floating ip list")
+            fips = [
+                {"id": f"fip{i}", "floating_ip_address": f"192.0.2.{i}"}
+                for i in range(3)
+            ]
+            return {"floatingips": fips}
+        raise NotFound(f"Call not available in the benchmark: {method} {path}")
+
+    def find_endpoint_and_project_id(self, site, vo):
+        self._call("fedcloudclient", "find_endpoint_and_project_id")
+        return f"https://{site.lower()}.example.org:5000/v3", f"{site}-project", "oidc"
+
+    def list_sites(self, vo):
+        self._call("fedcloudclient", "list_sites")
+        return self.sites
+
+    def get_access_token(
+        self, oidc_access_token, oidc_agent_account, mytoken, mytoken_server
+    ):
+        self._call("fedcloudclient", "get_access_token")
+        return oidc_access_token
+
+    # AppDB, GOCDB and accounting, replace the shared HTTP client
+
+    def http_get(self, url, **kwargs):
+        if "appdb" in url:
+            return self.appdb_get(url, **kwargs)
+        if "gocdbpi" in url:
+            return self.gocdb_get(url, **kwargs)
+        return self.accounting_get(url, **kwargs)
+
+    def appdb_get(self, url, params=None, **kwargs):
+        self._call("appdb", "graphql")
+        shares = {"items": [{"VO": VO}, {"VO": "ops"}]}
+        items = [{"name": site, "cloudComputingShares": shares} for site in self.sites]
+        return FakeResponse(json.dumps({"data": {"sites": {"items": items}}}))
+
+    def _endpoint(self, i, site):
+        return {
+            "@PRIMARY_KEY": f"{i}G0",
+            "HOSTNAME": f"{site.lower()}.example.org",
+            "SERVICE_TYPE": "org.openstack.nova",
+            "SITENAME": site,
+        }
+
+    def gocdb_get(self, url, params=None, cert=None, **kwargs):
+        method = params["method"]
+        self._call("gocdb", method)
+        if method == "get_service_group":
+            groups = [
+                {
+                    "NAME": f"EGI_{sla_name}_SLA",
+                    "SERVICE_ENDPOINT": [
+                        self._endpoint(i, site) for i, site in enumerate(self.sites)
+                    ],
+                }
+                for sla_name in self.sla_names
+            ]
+            results = {"results": {"SERVICE_GROUP": groups}}
+        else:
+            endpoints = [
+                self._endpoint(i, site)
+                for i, site in enumerate(self.sites)
+                if "hostname" not in params
+                or params["hostname"] == f"{site.lower()}.example.org"
+            ]
+            results = {"results": {"SERVICE_ENDPOINT": endpoints}}
+        return FakeResponse(xmltodict.unparse(results))
+
+    def accounting_get(self, url, **kwargs):
+        self._call("accounting", "site_vo")
+        data = [
+            {"id": site, VO: 1000.0 + i, "ops": 1.0, "Total": 1001.0 + i}
+            for i, site in enumerate(self.sites)
+        ]
+        legend = {"id": "xlegend"}
+        legend.update({str(i): site for i, site in enumerate(self.sites)})
+        data.append(legend)
+        return FakeResponse(json.dumps(data))
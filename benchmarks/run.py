@@ -0,0 +1,184 @@
+"""Offline benchmark of fedcloud-vo-monitor and fedcloud-sla-monitor
+
+Runs the monitors against a synthetic federation, with every external
+service replaced in-process, and reports wall time, calls made to each
+service and peak memory.
+
+    python benchmarks/run.py --sites 50 --vms 2000 --latency 0.01
+
+The benchmark is not part of the tests, run it before and after a change
+with the same parameters to compare the results.
+"""
+
+import contextlib
+import io
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_services import FakeFederation  # noqa: E402
+from fedcloud_monitoring_tools import sla_monitor_cli, vm_monitor_cli  # noqa: E402
+
+
+def patch_services(federation):
+    """Replaces all the external services with the synthetic federation"""
+    stack = contextlib.ExitStack()
+    patches = [
+        (
+            "fedcloud_monitoring_tools.openstack_api.fedcloud_openstack_cli",
+            federation.openstack,
+        ),
+        (
+            "fedcloud_monitoring_tools.openstack_api.find_endpoint_and_project_id",
+            federation.find_endpoint_and_project_id,
+        ),
+        ("fedcloud_monitoring_tools.vm_monitor_cli.list_sites", federation.list_sites),
+        # the fake token is not a JWT that Check-in would accept
+        (
+            "fedcloud_monitoring_tools.vm_monitor_cli.get_access_token",
+            federation.get_access_token,
+        ),
+        ("fedcloud_monitoring_tools.http_client.get", federation.http_get),
+        # the api backend calls the OpenStack APIs in-process
+        (
+            "fedcloud_monitoring_tools.openstack_api.session.Session",
+            federation.keystone_session,
+        ),
+        (
+            "fedcloud_monitoring_tools.openstack_api.adapter.Adapter",
+            federation.keystone_adapter,
+        ),
+        ("fedcloud_monitoring_tools.openstack_api._sessions", {}),
+    ]
+    for target, replacement in patches:
+        stack.enter_context(mock.patch(target, replacement))
+    return stack
+
+
+def run_main(main, args, federation):
+    """Runs the CLI main with args, returns the measurements of the run"""
+    federation.calls.clear()
+    output = io.StringIO()
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    with patch_services(federation), contextlib.redirect_stdout(
+        output
+    ), contextlib.redirect_stderr(output):
+        try:
+            main.main(args, standalone_mode=False)
+        except (Exception, SystemExit) as e:
+            # fedcloudclient exits on some errors, e.g. without a valid token
+            error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = {}
+    for (service, operation), count in sorted(federation.calls.items()):
+        calls[f"{service} {operation}"] = count
+    # errors of the sites are shown, they do not stop the run
+    site_errors = [
+        line for line in output.getvalue().splitlines() if line.startswith("ERROR:")
+    ]
+    return {
+        "wall_seconds": elapsed,
+        "peak_memory_mb": peak / 2**20,
+        "total_calls": sum(federation.calls.values()),
+        "calls": calls,
+        "output_lines": output.getvalue().count("\n"),
+        "error": error,
+        "site_errors": site_errors,
+    }
+
+
+def show_result(name, result):
+    click.secho(f"[.] {name}", fg="blue", bold=True)
+    click.echo(f"    {'wall time':<46} = {result['wall_seconds']:.2f} s")
+    click.echo(f"    {'peak memory':<46} = {result['peak_memory_mb']:.1f} MB")
+    click.echo(f"    {'calls':<46} = {result['total_calls']}")
+    for call, count in result["calls"].items():
+        click.echo(f"      {call:<44} = {count}")
+    if result["error"]:
+        click.secho(f"    ERROR: {result['error']}", fg="red")
+    if result["site_errors"]:
+        click.secho(
+            f"    ERROR: {len(result['site_errors'])} site error(s), first one: "
+            f"{result['site_errors'][0]}",
+            fg="red",
+        )
+
+
+@click.command()
+@click.option("--sites", default=5, show_default=True, help="Number of sites")
+@click.option("--vms", default=200, show_default=True, help="Number of VMs per site")
+@click.option(
+    "--latency",
+    default=0.0,
+    show_default=True,
+    help="Seconds every call to a service takes",
+)
+@click.option(
+    "--vo-monitor-args",
+    default="--parallel-sites 1 --parallel-vms 1",
+    show_default=True,
+    help="Additional arguments for fedcloud-vo-monitor",
+)
+@click.option(
+    "--sla-monitor-args",
+    default="",
+    show_default=True,
+    help="Additional arguments for fedcloud-sla-monitor",
+)
+@click.option("--skip-vo-monitor", is_flag=True, help="Do not run fedcloud-vo-monitor")
+@click.option(
+    "--skip-sla-monitor", is_flag=True, help="Do not run fedcloud-sla-monitor"
+)
+@click.option("--json-output", is_flag=True, help="Show the results as JSON")
+def main(
+    sites,
+    vms,
+    latency,
+    vo_monitor_args,
+    sla_monitor_args,
+    skip_vo_monitor,
+    skip_sla_monitor,
+    json_output,
+):
+    federation = FakeFederation(sites=sites, vms=vms, latency=latency)
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_home:
+        # keep the metadata cache and the state of the runs apart
+        os.environ["XDG_CACHE_HOME"] = cache_home
+        if not skip_vo_monitor:
+            args = ["--oidc-access-token", "benchmark"]
+            results["fedcloud-vo-monitor"] = run_main(
+                vm_monitor_cli.main, args + shlex.split(vo_monitor_args), federation
+            )
+        if not skip_sla_monitor:
+            args = ["--user-cert", "benchmark.pem"]
+            results["fedcloud-sla-monitor"] = run_main(
+                sla_monitor_cli.main, args + shlex.split(sla_monitor_args), federation
+            )
+    if json_output:
+        click.echo(json.dumps(results))
+    else:
+        for name, result in results.items():
+            show_result(name, result)
+    if any(result["error"] or result["site_errors"] for result in results.values()):
+        # results of runs with errors are not worth comparing
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
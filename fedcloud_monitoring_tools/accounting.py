@@ -2,8 +2,11 @@
 
 import datetime
 import numbers
+import threading
 
-import httpx
+from fedcloud_monitoring_tools import http_client
+from fedcloud_monitoring_tools.cache import MetadataCache
+from fedcloud_monitoring_tools.profiling import profiler
 
 ACCOUNTING_URL = "https://accounting.egi.eu/"
 SITE_VO_ACCOUNTING = (
@@ -11,47 +14,94 @@ SITE_VO_ACCOUNTING = (
     "{start_year}/{start_month}/{end_year}/{end_month}"
     "/all/onlyinfrajobs/JSON/"
 )
+# columns of the sites that are not VOs
+NON_VO_COLUMNS = ["id", "Total", "Percent"]
 
 
 class Accounting:
-    def __init__(self):
-        self._data = {}
+    def __init__(self, cache=None, days=90):
+        self.cache = cache or MetadataCache(enabled=False)
+        self.days = days
+        self._data = []
+        # usage of each VO at each site, only VOs with some usage
+        self._site_usage = None
+        self._sites = []
+        self._lock = threading.Lock()
 
-    def _get_accounting_data(self):
-        """Gets accounting data for sites / vos over the last 90 days"""
+    def _url(self):
         today = datetime.date.today()
-        start = today - datetime.timedelta(days=90)
-        url = ACCOUNTING_URL + SITE_VO_ACCOUNTING.format(
+        start = today - datetime.timedelta(days=self.days)
+        return ACCOUNTING_URL + SITE_VO_ACCOUNTING.format(
             start_year=start.year,
             start_month=start.month,
             end_year=today.year,
             end_month=today.month,
         )
-        # accounting generates a redirect here
-        r = httpx.get(url, follow_redirects=True)
-        self._data = r.json()
+
+    def _get_accounting_data(self):
+        """Gets accounting data for sites / vos over the last days
+
+        The data is kept in the metadata cache. Once expired, it is only
+        downloaded again if it changed since it was cached.
+        """
+        url = self._url()
+        cached = self.cache.get("accounting", url)
+        if cached is not None:
+            self._data = cached["data"]
+            return self._data
+        stale = self.cache.get_stale("accounting", url) or {}
+        headers = {}
+        if stale.get("etag"):
+            headers["If-None-Match"] = stale["etag"]
+        if stale.get("last_modified"):
+            headers["If-Modified-Since"] = stale["last_modified"]
+        with profiler.timed("accounting", detail=url):
+            # accounting generates a redirect here
+            r = http_client.get(url, headers=headers, follow_redirects=True)
+        if r.status_code == 304 and stale:
+            self._data = stale["data"]
+        else:
+            r.raise_for_status()
+            self._data = r.json()
+        self.cache.set(
+            "accounting",
+            url,
+            {
+                "etag": r.headers.get("etag") or stale.get("etag"),
+                "last_modified": r.headers.get("last-modified")
+                or stale.get("last_modified"),
+                "data": self._data,
+            },
+        )
         return self._data
 
+    def _load(self):
+        """Indexes the usage of every VO by site"""
+        with self._lock:
+            if self._site_usage is not None:
+                return
+            site_usage = {}
+            for col in self._get_accounting_data():
+                if col["id"] == "xlegend":
+                    self._sites = [site[1] for site in col.items() if site[0] != "id"]
+                    continue
+                site_usage[col["id"]] = {
+                    vo: usage
+                    for vo, usage in col.items()
+                    if isinstance(usage, numbers.Number)
+                    and usage != 0
+                    and vo not in NON_VO_COLUMNS
+                }
+            self._site_usage = site_usage
+
+    def site_usage(self, site):
+        """Usage of every VO with some usage at the site"""
+        self._load()
+        return self._site_usage.get(site, {})
+
     def site_vos(self, site):
-        if not self._data:
-            self._get_accounting_data()
-        for col in self._data:
-            if col["id"] == site:
-                return set(
-                    [
-                        vo[0]
-                        for vo in col.items()
-                        if isinstance(vo[1], numbers.Number)
-                        and vo[1] != 0
-                        and vo[0] not in ["Total", "Percent"]
-                    ]
-                )
-        return set([])
+        return set(self.site_usage(site))
 
     def all_sites(self):
-        if not self._data:
-            self._get_accounting_data()
-        for col in self._data:
-            if col["id"] == "xlegend":
-                return [site[1] for site in col.items() if site[0] != "id"]
-        return []
+        self._load()
+        return self._sites
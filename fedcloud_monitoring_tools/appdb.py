@@ -1,20 +1,16 @@
 """AppDB queries"""
 
-import requests
+import threading
 
-sites_supporting_vo_query = """
-{
-  sites(filter: {cloudComputingShares: {VO: {eq: "%s"}}}) {
-    items {
-      name
-    }
-  }
-}"""
+from fedcloud_monitoring_tools import http_client
+from fedcloud_monitoring_tools.cache import MetadataCache
+from fedcloud_monitoring_tools.profiling import profiler
 
-vos_in_site_query = """
+all_sites_query = """
 {
-  sites(filter: {name: {eq: "%s"}}) {
+  sites {
     items {
+      name
       cloudComputingShares {
         items {
           VO
@@ -28,32 +24,54 @@ vos_in_site_query = """
 class AppDB:
     graphql_url = "https://is.appdb.egi.eu/graphql"
 
-    def __init__(self):
-        self.sites = {}
+    def __init__(self, cache=None):
+        self.cache = cache or MetadataCache(enabled=False)
+        # VOs supported at each site and sites supporting each VO
+        self.site_vos = None
+        self.vo_sites = None
+        self._lock = threading.Lock()
 
-    def get_sites_for_vo(self, vo):
-        params = {"query": sites_supporting_vo_query % vo}
-        r = requests.get(
-            self.graphql_url, params=params, headers={"accept": "application/json"}
-        )
+    def _get_site_vos(self):
+        site_vos = self.cache.get("appdb_site_vos", "all")
+        if site_vos is not None:
+            return site_vos
+        params = {"query": all_sites_query}
+        with profiler.timed("appdb graphql", detail="all sites"):
+            r = http_client.get(
+                self.graphql_url, params=params, headers={"accept": "application/json"}
+            )
         r.raise_for_status()
-        data = r.json()["data"]["sites"]["items"]
-        return [i["name"] for i in data]
+        site_vos = {}
+        for site in r.json()["data"]["sites"]["items"]:
+            shares = (site.get("cloudComputingShares") or {}).get("items") or []
+            vos = site_vos.setdefault(site["name"], [])
+            for share in shares:
+                if share["VO"] not in vos:
+                    vos.append(share["VO"])
+        self.cache.set("appdb_site_vos", "all", site_vos)
+        return site_vos
+
+    def load_index(self):
+        """Gets all the sites and their VOs in a single query and indexes them"""
+        with self._lock:
+            if self.site_vos is not None:
+                return
+            site_vos = self._get_site_vos()
+            vo_sites = {}
+            for site, vos in site_vos.items():
+                for vo in vos:
+                    vo_sites.setdefault(vo, []).append(site)
+            self.vo_sites = vo_sites
+            self.site_vos = site_vos
+
+    def get_sites_for_vo(self, vo):
+        self.load_index()
+        return list(self.vo_sites.get(vo, []))
 
     def vo_check(self, site, vo):
-        if not self.sites:
-            self.sites = self.get_sites_for_vo(vo)
-        return site in self.sites
+        self.load_index()
+        return vo in self.site_vos.get(site, [])
 
     def get_vo_for_site(self, site):
-        params = {"query": vos_in_site_query % site}
-        r = requests.get(
-            self.graphql_url, params=params, headers={"accept": "application/json"}
-        )
-        r.raise_for_status()
-        sites_items = r.json()["data"]["sites"]["items"]
-        if sites_items:
-            data = sites_items.pop()["cloudComputingShares"]["items"]
-        else:
-            return []
-        return [i["VO"] for i in data]
+        self.load_index()
+        return list(self.site_vos.get(site, []))
@@ -0,0 +1,107 @@
+"""Persistent cache for slow-changing metadata"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+# seconds each kind of information is considered valid
+DEFAULT_TTLS = {
+    "accounting": 6 * 3600,
+    "appdb_site_vos": 6 * 3600,
+    "flavors": 24 * 3600,
+    "goc_service_lists": 24 * 3600,
+    "goc_services": 24 * 3600,
+    "images": 6 * 3600,
+    "users": 6 * 3600,
+}
+DEFAULT_TTL = 3600
+
+
+def default_cache_file():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "fedcloud-monitoring-tools" / "cache.sqlite"
+
+
+class MetadataCache:
+    """On-disk cache of JSON values indexed by kind and key
+
+    Each kind has its own TTL. When refresh is set, stored values are not
+    used but the cache is updated with the new ones. A disabled cache never
+    stores anything, so it can be used when no cache is wanted.
+    """
+
+    def __init__(self, path=None, ttls={}, refresh=False, enabled=True):
+        self.ttls = dict(DEFAULT_TTLS, **ttls)
+        self.refresh = refresh
+        self.enabled = enabled
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._lock = threading.Lock()
+        self._db = None
+        if enabled:
+            path = Path(path or default_cache_file())
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "kind TEXT, key TEXT, value TEXT, updated REAL, "
+                "PRIMARY KEY (kind, key))"
+            )
+            self._db.commit()
+
+    def _key(self, key):
+        return json.dumps(key)
+
+    def get(self, kind, key):
+        """Cached value for the kind and key, None if missing or expired"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = None
+            if not self.refresh:
+                row = self._db.execute(
+                    "SELECT value, updated FROM cache WHERE kind = ? AND key = ?",
+                    (kind, self._key(key)),
+                ).fetchone()
+            if row and time.time() - row[1] < self.ttls.get(kind, DEFAULT_TTL):
+                self.hits[kind] += 1
+                return json.loads(row[0])
+            self.misses[kind] += 1
+            return None
+
+    def get_stale(self, kind, key):
+        """Cached value for the kind and key even if expired, None if missing
+
+        Used for revalidating the value with its source, it does not count
+        as a hit or a miss.
+        """
+        if not self.enabled or self.refresh:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM cache WHERE kind = ? AND key = ?",
+                (kind, self._key(key)),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, kind, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (kind, self._key(key), json.dumps(value), time.time()),
+            )
+            self._db.commit()
+
+    def report(self):
+        """Summary of hits and misses per kind"""
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return ", ".join(
+            f"{kind}: {self.hits[kind]} hit(s), {self.misses[kind]} miss(es)"
+            for kind in kinds
+        )
@@ -0,0 +1,157 @@
+"""Non-interactive deletion of the VMs allowed by a policy"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fedcloud_monitoring_tools.site_monitor import SiteMonitorException
+
+# deletions waiting at the same time for the rate limit of a site
+DELETE_WORKERS = 10
+
+
+class DeletionPolicy:
+    """Decides which VMs can be deleted without asking
+
+    VMs are deleted once they run for max_days. Empty vos and statuses mean
+    any VO and any status. VMs with any of the keep_tags or created by any
+    of the keep_orchestrators are never deleted, nor are VMs without known
+    tags if there are keep_tags.
+    """
+
+    def __init__(
+        self, max_days, vos=(), statuses=(), keep_tags=(), keep_orchestrators=()
+    ):
+        self.max_days = max_days
+        self.vos = set(vos)
+        self.statuses = {status.upper() for status in statuses}
+        self.keep_tags = set(keep_tags)
+        self.keep_orchestrators = set(keep_orchestrators)
+
+    def keep_reason(self, vo, record):
+        """Why the VM must be kept, None if it can be deleted"""
+        if record.elapsed.days < self.max_days:
+            return f"running for less than {self.max_days} days"
+        if self.vos and vo not in self.vos:
+            return f"VO {vo} not in the policy"
+        if self.statuses and record.status not in self.statuses:
+            return f"status {record.status} not in the policy"
+        if self.keep_tags and record.tags is None:
+            # the site does not return tags, any of them could be there
+            return "tags not available to check the tags to keep"
+        tags = self.keep_tags.intersection(record.tags or ())
+        if tags:
+            return f"tagged {', '.join(sorted(tags))}"
+        if record.orchestrator in self.keep_orchestrators:
+            return f"created by {record.orchestrator}"
+        return None
+
+
+class RateLimiter:
+    """Spaces the calls made from any thread to at most rate per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BulkDeleter:
+    """Deletes the VMs of a site allowed by the policy
+
+    Deletions are issued concurrently, at most rate per second at each
+    site, and then confirmed with a single server list every poll_interval
+    seconds until the VMs are gone or the timeout expires.
+    """
+
+    def __init__(self, policy, dry_run=False, rate=2.0, timeout=600, poll_interval=5):
+        self.policy = policy
+        self.dry_run = dry_run
+        self.rate = rate
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def select(self, site_monitor, records):
+        """VMs of the site over max days that the policy allows to delete"""
+        to_delete = []
+        for record in records:
+            if not record.over_max_days:
+                continue
+            reason = self.policy.keep_reason(site_monitor.vo, record)
+            action = "keep" if reason else "dry_run" if self.dry_run else "delete"
+            if not site_monitor.emit(
+                "deletion", id=record.id, action=action, reason=reason
+            ):
+                if reason:
+                    site_monitor.echo(f"[.] Keeping VM {record.id}: {reason}")
+                elif self.dry_run:
+                    site_monitor.secho(
+                        f"[-] Would delete VM {record.id} ({record.name}), "
+                        f"{record.status} for {record.elapsed.days} days",
+                        fg="yellow",
+                    )
+            if not reason:
+                to_delete.append(record.id)
+        return to_delete
+
+    def run(self, site_monitor, records):
+        """Deletes the VMs, returns the IDs of those still there"""
+        to_delete = self.select(site_monitor, records)
+        if self.dry_run or not to_delete:
+            return []
+        limiter = RateLimiter(self.rate)
+        failed = {}
+
+        def delete(vm_id):
+            limiter.wait()
+            try:
+                site_monitor.delete_vm({"ID": vm_id}, do_raise=True)
+            except SiteMonitorException as e:
+                failed[vm_id] = str(e)
+
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+            list(executor.map(delete, to_delete))
+        pending = self.wait_until_gone(
+            site_monitor, [vm_id for vm_id in to_delete if vm_id not in failed]
+        )
+        deleted = [vm_id for vm_id in to_delete if vm_id not in set(failed) | pending]
+        if not site_monitor.emit(
+            "deletion_result",
+            deleted=deleted,
+            failed=failed,
+            pending=sorted(pending),
+        ):
+            site_monitor.echo(f"[+] Deleted {len(deleted)} VM(s)")
+            for vm_id, error in failed.items():
+                site_monitor.secho(
+                    f"[-] WARNING: could not delete VM {vm_id}: {error.strip()}",
+                    fg="yellow",
+                )
+            if pending:
+                site_monitor.secho(
+                    f"[-] WARNING: VM(s) still there after {self.timeout} "
+                    f"seconds: {sorted(pending)}",
+                    fg="yellow",
+                )
+        return sorted(set(failed) | pending)
+
+    def wait_until_gone(self, site_monitor, vm_ids):
+        """Polls the server list until the VMs are gone, returns those left"""
+        pending = set(vm_ids)
+        deadline = time.monotonic() + self.timeout
+        while pending and time.monotonic() < deadline:
+            time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+            try:
+                # one call confirms all the deletions of the site
+                pending &= {vm["ID"] for vm in site_monitor.list_vms()}
+            except SiteMonitorException as e:
+                site_monitor.secho(f"[-] WARNING: {e}", fg="yellow")
+        return pending
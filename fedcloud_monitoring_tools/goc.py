@@ -2,8 +2,10 @@
 
 import re
 
-import httpx
 import xmltodict
+from fedcloud_monitoring_tools import http_client
+from fedcloud_monitoring_tools.cache import MetadataCache
+from fedcloud_monitoring_tools.profiling import profiler
 
 GOC_PUBLIC_URL = "https://goc.egi.eu/gocdbpi/public/"
 GOC_PRIVATE_URL = "https://goc.egi.eu/gocdbpi/private/"
@@ -11,21 +13,76 @@ SERVICE_TYPES = ["org.openstack.nova"]
 SLA_GROUP_RE = r"EGI_(.*)_SLA"
 
 
+def _as_list(value):
+    # xmltodict gives a single dict when there is only one element
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
 class GOCDB:
-    def __init__(self):
+    def __init__(self, cache=None):
         self._cache = {}
+        self.cache = cache or MetadataCache(enabled=False)
         self.queries = 0
         self.sla_vos = set()
+        # service endpoints of SERVICE_TYPES by primary key and by hostname
+        self.services_by_key = {}
+        self.services_by_hostname = {}
 
     def get_sla_groups(self, cert_file, scope="EGI,SLA"):
-        client = httpx.Client(cert=cert_file)
         params = {"method": "get_service_group", "scope": scope}
-        response = client.get(GOC_PRIVATE_URL, params=params)
+        with profiler.timed("gocdb get_service_group"):
+            response = http_client.get(GOC_PRIVATE_URL, cert=cert_file, params=params)
         self.queries += 1
         groups = xmltodict.parse(response.text)["results"]["SERVICE_GROUP"]
-        return groups
+        return _as_list(groups)
+
+    def get_services(self, service_type):
+        """All the service endpoints of the type, going through every page"""
+        services = self.cache.get("goc_service_lists", service_type)
+        if services is not None:
+            return services
+        services = []
+        page = 1
+        while True:
+            params = {
+                "method": "get_service",
+                "service_type": service_type,
+                "page": page,
+            }
+            with profiler.timed("gocdb get_service", detail=f"{service_type} #{page}"):
+                r = http_client.get(GOC_PUBLIC_URL, params=params)
+            self.queries += 1
+            results = (xmltodict.parse(r.text).get("results") if r.text else {}) or {}
+            page_services = _as_list(results.get("SERVICE_ENDPOINT"))
+            services.extend(page_services)
+            if not page_services or not self._has_next_page(results):
+                break
+            page += 1
+        self.cache.set("goc_service_lists", service_type, services)
+        return services
+
+    def _has_next_page(self, results):
+        meta = results.get("meta") or {}
+        return any(
+            link.get("@rel") == "next" and link.get("@href")
+            for link in _as_list(meta.get("link"))
+        )
+
+    def load_service_index(self):
+        """Indexes all the service endpoints of SERVICE_TYPES"""
+        for service_type in SERVICE_TYPES:
+            for service in self.get_services(service_type):
+                if "@PRIMARY_KEY" in service:
+                    self.services_by_key[service["@PRIMARY_KEY"]] = service
+                if "HOSTNAME" in service:
+                    self.services_by_hostname[(service["HOSTNAME"], service_type)] = (
+                        service
+                    )
 
     def get_sites_slas(self, cert_file, vo_map):
+        self.load_service_index()
         groups = self.get_sla_groups(cert_file)
         all_vos = []
         for vo in vo_map.values():
@@ -62,12 +119,23 @@ class GOCDB:
             return self._cache[key]
         if endpoint.get("SERVICE_TYPE", "") not in SERVICE_TYPES:
             return None
+        indexed = self.services_by_key.get(key) or self.services_by_hostname.get(
+            (endpoint.get("HOSTNAME"), endpoint["SERVICE_TYPE"])
+        )
+        if indexed:
+            self._cache[key] = indexed
+            return indexed
+        cached = self.cache.get("goc_services", key)
+        if cached:
+            self._cache[key] = cached
+            return cached
         params = {"method": "get_service"}
         if "HOSTNAME" in endpoint:
             params["hostname"] = endpoint["HOSTNAME"]
         if "SERVICE_TYPE" in endpoint:
             params["service_type"] = endpoint["SERVICE_TYPE"]
-        r = httpx.get(GOC_PUBLIC_URL, params=params)
+        with profiler.timed("gocdb get_service", detail=endpoint.get("HOSTNAME")):
+            r = http_client.get(GOC_PUBLIC_URL, params=params)
         self.queries += 1
         if r.text:
             results = xmltodict.parse(r.text).get("results", {})
@@ -75,4 +143,5 @@ class GOCDB:
                 service = results.get("SERVICE_ENDPOINT", {})
         if service:
             self._cache[key] = service
+            self.cache.set("goc_services", key, service)
         return service
@@ -0,0 +1,177 @@
+"""History of the results of every run of each site and VO"""
+
+import sqlite3
+import statistics
+import threading
+from pathlib import Path
+
+from fedcloud_monitoring_tools.cache import default_cache_file
+
+DAY = 24 * 3600
+
+
+def default_history_file():
+    return default_cache_file().with_name("history.sqlite")
+
+
+def run_summary(max_days, records, floating_ips, volumes):
+    """Values of a run of a site and VO stored in the history"""
+    ages = [record.elapsed.total_seconds() / DAY for record in records]
+    return {
+        "max_days": max_days,
+        "vms": len(records),
+        "vms_over_max_days": sum(1 for record in records if record.over_max_days),
+        "oldest_vm_days": max(ages, default=0),
+        "median_vm_days": statistics.median(ages) if ages else 0,
+        "unused_floating_ips": len(floating_ips),
+        "unused_volumes": len(volumes),
+        "unused_volumes_gb": sum(volume["Size"] for volume in volumes),
+    }
+
+
+class HistoryStore:
+    """On-disk history of the runs of each site and VO
+
+    Every run adds one row with the VM counts and ages and the unused
+    resources, and one row per quota resource, indexed by site, VO and time
+    of the run (seconds since the epoch).
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        path = Path(path or default_history_file())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "site TEXT, vo TEXT, taken_at REAL, max_days INTEGER, vms INTEGER, "
+            "vms_over_max_days INTEGER, oldest_vm_days REAL, median_vm_days REAL, "
+            "unused_floating_ips INTEGER, unused_volumes INTEGER, "
+            "unused_volumes_gb REAL, PRIMARY KEY (site, vo, taken_at)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS runs_taken_at ON runs (taken_at);"
+            "CREATE TABLE IF NOT EXISTS quotas ("
+            "site TEXT, vo TEXT, taken_at REAL, resource TEXT, "
+            "quota_limit REAL, in_use REAL, "
+            "PRIMARY KEY (site, vo, taken_at, resource)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS quotas_taken_at ON quotas (taken_at);"
+        )
+        self._db.commit()
+
+    def add(self, site, vo, taken_at, summary, quotas={}):
+        """Adds a run, quotas has the limit and in use of every resource"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO runs VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    site,
+                    vo,
+                    taken_at,
+                    summary["max_days"],
+                    summary["vms"],
+                    summary["vms_over_max_days"],
+                    summary["oldest_vm_days"],
+                    summary["median_vm_days"],
+                    summary["unused_floating_ips"],
+                    summary["unused_volumes"],
+                    summary["unused_volumes_gb"],
+                ),
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO quotas VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (site, vo, taken_at, resource, quota["limit"], quota["in_use"])
+                    for resource, quota in quotas.items()
+                ],
+            )
+            self._db.commit()
+
+    def _filter(self, since, site=None, vo=None):
+        conditions, params = ["taken_at >= ?"], [since]
+        if site:
+            conditions.append("site = ?")
+            params.append(site)
+        if vo:
+            conditions.append("vo = ?")
+            params.append(vo)
+        return " AND ".join(conditions), params
+
+    def vm_trends(self, since, site=None, vo=None):
+        """VM counts and ages of the first and last runs since the time"""
+        where, params = self._filter(since, site, vo)
+        query = (
+            "WITH period AS ("
+            "SELECT site, vo, COUNT(*) AS runs, MIN(taken_at) AS first, "
+            "MAX(taken_at) AS last, MAX(vms_over_max_days) AS peak_over "
+            f"FROM runs WHERE {where} GROUP BY site, vo) "
+            "SELECT p.site, p.vo, p.runs, p.first, p.last, f.vms, l.vms, "
+            "f.vms_over_max_days, l.vms_over_max_days, p.peak_over, "
+            "l.max_days, l.oldest_vm_days, l.median_vm_days, "
+            "l.unused_floating_ips, l.unused_volumes_gb "
+            "FROM period p "
+            "JOIN runs f ON f.site = p.site AND f.vo = p.vo AND f.taken_at = p.first "
+            "JOIN runs l ON l.site = p.site AND l.vo = p.vo AND l.taken_at = p.last "
+            "ORDER BY p.site, p.vo"
+        )
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        trends = []
+        for row in rows:
+            days = (row[4] - row[3]) / DAY
+            trends.append(
+                {
+                    "site": row[0],
+                    "vo": row[1],
+                    "runs": row[2],
+                    "first": row[3],
+                    "last": row[4],
+                    "vms_first": row[5],
+                    "vms_last": row[6],
+                    # VMs added or removed every 30 days, not known from
+                    # runs less than a day apart
+                    "vms_growth_30d": (
+                        (row[6] - row[5]) / days * 30 if days >= 1 else None
+                    ),
+                    "over_max_days_first": row[7],
+                    "over_max_days_last": row[8],
+                    "over_max_days_peak": row[9],
+                    "max_days": row[10],
+                    "oldest_vm_days": row[11],
+                    "median_vm_days": row[12],
+                    "unused_floating_ips": row[13],
+                    "unused_volumes_gb": row[14],
+                }
+            )
+        return trends
+
+    def quota_saturation(self, since, threshold, site=None, vo=None):
+        """Quota resources used over threshold (0 to 1) in any run since the time
+
+        Resources without limit are ignored.
+        """
+        where, params = self._filter(since, site, vo)
+        query = (
+            "WITH period AS ("
+            "SELECT site, vo, resource, MAX(in_use / quota_limit) AS peak, "
+            "MAX(taken_at) AS last "
+            f"FROM quotas WHERE {where} AND quota_limit > 0 "
+            "GROUP BY site, vo, resource HAVING peak >= ?) "
+            "SELECT p.site, p.vo, p.resource, p.peak, q.in_use, q.quota_limit "
+            "FROM period p JOIN quotas q ON q.site = p.site AND q.vo = p.vo "
+            "AND q.resource = p.resource AND q.taken_at = p.last "
+            "ORDER BY p.peak DESC, p.site, p.vo, p.resource"
+        )
+        with self._lock:
+            rows = self._db.execute(query, params + [threshold]).fetchall()
+        return [
+            {
+                "site": row[0],
+                "vo": row[1],
+                "resource": row[2],
+                "peak": row[3],
+                "in_use": row[4],
+                "limit": row[5],
+                "last": row[4] / row[5],
+            }
+            for row in rows
+        ]
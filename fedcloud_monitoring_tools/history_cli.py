@@ -0,0 +1,94 @@
+"""Trends in the history of the VO monitor runs"""
+
+import json
+import time
+from datetime import datetime, timezone
+
+import click
+from fedcloud_monitoring_tools.history import DAY, HistoryStore
+
+
+def _date(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def show_vm_trends(trends):
+    click.secho("[.] VMs:", fg="blue", bold=True)
+    click.echo(
+        f"    {'site / VO':<48} {'runs':>5} {'VMs':>11} {'per 30d':>8} "
+        f"{'over max':>10} {'peak':>5} {'oldest':>7}"
+    )
+    for trend in trends:
+        name = f"{trend['site']} / {trend['vo']}"
+        vms = f"{trend['vms_first']} -> {trend['vms_last']}"
+        over = f"{trend['over_max_days_first']} -> {trend['over_max_days_last']}"
+        growth = trend["vms_growth_30d"]
+        growth = "n/a" if growth is None else f"{growth:+.1f}"
+        click.echo(
+            f"    {name:<48} {trend['runs']:>5} {vms:>11} "
+            f"{growth:>8} {over:>10} "
+            f"{trend['over_max_days_peak']:>5} {trend['oldest_vm_days']:>6.0f}d"
+        )
+
+
+def show_quota_saturation(saturation, threshold):
+    click.secho(
+        f"[.] Quotas used over {threshold:.0%} in any run:", fg="blue", bold=True
+    )
+    if not saturation:
+        click.echo("    none")
+    for quota in saturation:
+        name = f"{quota['site']} / {quota['vo']} / {quota['resource']}"
+        click.echo(
+            f"    {name:<60} peak {quota['peak']:>4.0%}, last {quota['last']:>4.0%} "
+            f"({quota['in_use']:.0f} of {quota['limit']:.0f})"
+        )
+
+
+@click.command()
+@click.option("--site", help="Restrict the trends to the site provided")
+@click.option("--vo", help="Restrict the trends to the VO provided")
+@click.option(
+    "--days",
+    default=180,
+    type=click.IntRange(min=1),
+    help="Number of days of history to consider",
+    show_default=True,
+)
+@click.option(
+    "--saturation",
+    default=0.9,
+    type=click.FloatRange(min=0, max=1),
+    help="Fraction of a quota limit considered saturated",
+    show_default=True,
+)
+@click.option(
+    "--history-file",
+    type=click.Path(dir_okay=False),
+    help="History file, the one of fedcloud-vo-monitor --history by default",
+)
+@click.option(
+    "--format",
+    "output_format",
+    default="text",
+    type=click.Choice(["text", "json"]),
+    help="Output format",
+    show_default=True,
+)
+def main(site, vo, days, saturation, history_file, output_format):
+    history = HistoryStore(history_file)
+    since = time.time() - days * DAY
+    trends = history.vm_trends(since, site, vo)
+    quotas = history.quota_saturation(since, saturation, site, vo)
+    if output_format == "json":
+        click.echo(json.dumps({"vms": trends, "quotas": quotas}))
+        return
+    if not trends:
+        click.secho(f"No runs in the history since {_date(since)}", fg="yellow")
+        return
+    click.echo(
+        f"[.] Trends from {_date(min(t['first'] for t in trends))} "
+        f"to {_date(max(t['last'] for t in trends))}"
+    )
+    show_vm_trends(trends)
+    show_quota_saturation(quotas, saturation)
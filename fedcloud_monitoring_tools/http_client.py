@@ -0,0 +1,133 @@
+"""Shared HTTP client for AppDB, GOCDB and the accounting portal
+
+One pool of keep-alive connections is used for the whole run, so the TLS
+handshake with each host is only done once. HTTP/2 is used if the h2
+package is installed. Failed requests are retried with exponential
+backoff.
+"""
+
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+DEFAULT_TIMEOUT = 30
+# hosts that need a longer timeout than the default one, in seconds
+HOST_TIMEOUTS = {"accounting.egi.eu": 120}
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+
+
+class HTTPClient:
+    """Pooled sync and async HTTP client with retries
+
+    A client is kept for each client certificate, as certificates can not
+    be set per request. The async client is bound to the event loop where
+    it is first used.
+    """
+
+    def __init__(
+        self,
+        retries=RETRIES,
+        backoff=BACKOFF,
+        http2=HTTP2_AVAILABLE,
+        timeouts={},
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.timeouts = dict(HOST_TIMEOUTS, **timeouts)
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+
+    def _timeout(self, url):
+        return self.timeouts.get(urlsplit(url).hostname, DEFAULT_TIMEOUT)
+
+    def _client(self, cert=None):
+        with self._lock:
+            if cert not in self._clients:
+                self._clients[cert] = httpx.Client(
+                    cert=cert, http2=self.http2, limits=POOL_LIMITS
+                )
+            return self._clients[cert]
+
+    def _async_client(self, cert=None):
+        with self._lock:
+            if cert not in self._async_clients:
+                self._async_clients[cert] = httpx.AsyncClient(
+                    cert=cert, http2=self.http2, limits=POOL_LIMITS
+                )
+            return self._async_clients[cert]
+
+    def _retry(self, attempt, response=None):
+        """True if the request should be tried again"""
+        if attempt >= self.retries:
+            return False
+        return response is None or response.status_code in RETRY_STATUS_CODES
+
+    def get(self, url, cert=None, **kwargs):
+        """GET the url, kwargs are passed to httpx"""
+        kwargs.setdefault("timeout", self._timeout(url))
+        attempt = 0
+        while True:
+            try:
+                response = self._client(cert).get(url, **kwargs)
+            except httpx.TransportError:
+                if not self._retry(attempt):
+                    raise
+            else:
+                if not self._retry(attempt, response):
+                    return response
+            time.sleep(self.backoff * 2**attempt)
+            attempt += 1
+
+    async def aget(self, url, cert=None, **kwargs):
+        """GET the url from a coroutine, kwargs are passed to httpx"""
+        kwargs.setdefault("timeout", self._timeout(url))
+        attempt = 0
+        while True:
+            try:
+                response = await self._async_client(cert).get(url, **kwargs)
+            except httpx.TransportError:
+                if not self._retry(attempt):
+                    raise
+            else:
+                if not self._retry(attempt, response):
+                    return response
+            await asyncio.sleep(self.backoff * 2**attempt)
+            attempt += 1
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def shared_client():
+    """The HTTP client shared by all the modules"""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = HTTPClient()
+        return _shared_client
+
+
+def get(url, **kwargs):
+    """GET the url with the shared client"""
+    return shared_client().get(url, **kwargs)
+
+
+async def aget(url, **kwargs):
+    """GET the url with the shared async client"""
+    return await shared_client().aget(url, **kwargs)
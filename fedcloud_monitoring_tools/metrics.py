@@ -0,0 +1,94 @@
+"""Metrics of the monitored sites in the Prometheus text format"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name: help of every metric, all of them are gauges
+METRICS = {
+    "fedcloud_vo_monitor_vms": "Number of VMs by status",
+    "fedcloud_vo_monitor_vms_over_max_days": "Number of VMs running over max days",
+    "fedcloud_vo_monitor_quota_limit": "Quota limit of the resource",
+    "fedcloud_vo_monitor_quota_in_use": "Quota in use of the resource",
+    "fedcloud_vo_monitor_unused_floating_ips": "Number of unused floating IPs",
+    "fedcloud_vo_monitor_unused_volumes": "Number of unused volumes",
+    "fedcloud_vo_monitor_unused_volumes_gb": "Capacity of the unused volumes in GB",
+    "fedcloud_vo_monitor_unused_security_groups": "Number of unused security groups",
+    "fedcloud_vo_monitor_scan_duration_seconds": "Duration of the last scan",
+    "fedcloud_vo_monitor_scan_success": "Whether the last scan had no errors",
+    "fedcloud_vo_monitor_last_scan_timestamp_seconds": "Time of the last scan",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+class MetricsRegistry:
+    """Latest samples of every site and VO
+
+    The samples of a site and VO are replaced as a whole after each scan,
+    so metrics of resources that are gone do not stay around.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def set_samples(self, site, vo, samples):
+        """Sets the samples of the site and VO
+
+        samples is a list of (name, labels, value), the site and vo labels
+        are added to all of them.
+        """
+        with self._lock:
+            self._samples[(site, vo)] = [
+                (name, dict(site=site, vo=vo, **labels), value)
+                for name, labels, value in samples
+            ]
+
+    def render(self):
+        with self._lock:
+            samples = [
+                s for site_samples in self._samples.values() for s in site_samples
+            ]
+        lines = []
+        for name, help_text in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for sample_name, labels, value in samples:
+                if sample_name == name:
+                    lines.append(f"{name}{{{_labels(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # do not log every scrape
+        pass
+
+
+def start_metrics_server(registry, address, port):
+    """Serves the metrics of the registry over HTTP in a background thread"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((address, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,588 @@
+"""In-process access to the OpenStack APIs of the sites
+
+Provides fedcloud_openstack_api, a replacement of fedcloudclient's
+fedcloud_openstack that keeps one authenticated Keystone session per
+site and VO and issues the REST calls directly instead of launching an
+openstack CLI process for every command. Results have the same shape as
+the JSON output of the CLI for the commands used by the monitor, image
+and volume lists also include the image properties of every item.
+
+Also provides fedcloud_openstack_cli, which still runs the openstack CLI
+but authenticates with the scoped token of the session instead of doing
+the whole OIDC authentication in every process. The endpoint and project
+of each site and VO are looked up only once for the run by the resolver.
+"""
+
+import json
+import os
+import subprocess  # nosec
+import threading
+
+from fedcloudclient.openstack import (
+    CONFLICTING_ENVS,
+    DEFAULT_IDENTITY_PROVIDER,
+    DEFAULT_PROTOCOL,
+    fedcloud_openstack,
+)
+from fedcloudclient.sites import find_endpoint_and_project_id
+from keystoneauth1 import adapter, session
+from keystoneauth1.exceptions import ClientException
+from keystoneauth1.identity import v3
+
+# same code as fedcloudclient uses when the VO is not available at the site
+MISSING_VO_ERROR_CODE = 11
+API_ERROR_CODE = 1
+PAGE_SIZE = 500
+# first compute API version returning the tags of the servers
+COMPUTE_MICROVERSION = "2.26"
+OPENSTACK_CLIENT = "openstack"
+# image attributes not shown as properties by "openstack image show"
+IMAGE_ATTRIBUTES = {
+    "checksum",
+    "container_format",
+    "created_at",
+    "disk_format",
+    "file",
+    "id",
+    "locations",
+    "min_disk",
+    "min_ram",
+    "name",
+    "os_hash_algo",
+    "os_hash_value",
+    "os_hidden",
+    "owner",
+    "protected",
+    "schema",
+    "self",
+    "size",
+    "status",
+    "tags",
+    "updated_at",
+    "virtual_size",
+    "visibility",
+}
+# quota names as shown by "openstack quota show"
+QUOTA_NAMES = {
+    "floatingip": "floating-ips",
+    "metadata_items": "properties",
+    "network": "networks",
+    "port": "ports",
+    "rbac_policy": "rbac-policies",
+    "router": "routers",
+    "security_group": "secgroups",
+    "security_group_rule": "secgroup-rules",
+    "subnet": "subnets",
+    "subnetpool": "subnet-pools",
+}
+# network quotas of the compute API, deprecated in favour of the network API
+COMPUTE_NETWORK_QUOTAS = {
+    "fixed_ips",
+    "floating_ips",
+    "networks",
+    "security_group_rules",
+    "security_groups",
+}
+IMAGE_STRING_FOR_BFV = "N/A (booted from volume)"
+
+
+def _option(command, name):
+    """Value of option name in the command tuple, None if not there"""
+    if name in command:
+        return command[command.index(name) + 1]
+    return None
+
+
+def _has_next(response, key):
+    """True if the list response links to a next page
+
+    Nova and Cinder give the link in <key>_links, Glance in next.
+    """
+    if response.get("next"):
+        return True
+    links = response.get(f"{key}_links") or []
+    return any(link.get("rel") == "next" for link in links)
+
+
+class SiteSession:
+    """Authenticated session with the OpenStack APIs of a site"""
+
+    def __init__(self, token, endpoint, protocol, project_id=None, domain_id=None):
+        self.token = token
+        self.endpoint = endpoint
+        self.project_id = project_id
+        auth = v3.OidcAccessToken(
+            endpoint,
+            DEFAULT_IDENTITY_PROVIDER,
+            protocol or DEFAULT_PROTOCOL,
+            access_token=token,
+            project_id=project_id,
+            domain_id=domain_id,
+        )
+        self.session = session.Session(auth=auth)
+        self._adapters = {}
+        self._image_names = {}
+        self._flavor_names = {}
+        # "server show" information of the servers in the last server list
+        self.server_details = {}
+
+    def _api(self, service_type):
+        if service_type not in self._adapters:
+            # the identity API is the one used for authenticating
+            endpoint_override = self.endpoint if service_type == "identity" else None
+            microversion = COMPUTE_MICROVERSION if service_type == "compute" else None
+            self._adapters[service_type] = adapter.Adapter(
+                self.session,
+                service_type=service_type,
+                interface="public",
+                endpoint_override=endpoint_override,
+                default_microversion=microversion,
+            )
+        return self._adapters[service_type]
+
+    def _get(self, service_type, path, **params):
+        return self._api(service_type).get(path, params=params).json()
+
+    def token_issue(self, command):
+        return {
+            "id": self.session.get_token(),
+            "project_id": self.session.get_project_id(),
+            "user_id": self.session.get_user_id(),
+        }
+
+    def user_list(self, command):
+        params = {}
+        domain_id = _option(command, "--os-domain-id")
+        if domain_id:
+            params["domain_id"] = domain_id
+        users = self._get("identity", "/users", **params)["users"]
+        return [{"ID": user["id"], "Name": user["name"]} for user in users]
+
+    def user_show(self, command):
+        return self._get("identity", f"/users/{command[2]}")["user"]
+
+    def flavor_list(self, command):
+        flavors = self._get("compute", "/flavors/detail", is_public="None")
+        result = []
+        for flv in flavors["flavors"]:
+            self._flavor_names[flv["id"]] = flv["name"]
+            result.append(
+                {
+                    "ID": flv["id"],
+                    "Name": flv["name"],
+                    "RAM": flv["ram"],
+                    "Disk": flv["disk"],
+                    "Ephemeral": flv.get("OS-FLV-EXT-DATA:ephemeral", 0),
+                    "VCPUs": flv["vcpus"],
+                    "Is Public": flv.get("os-flavor-access:is_public", True),
+                    "Swap": flv.get("swap", ""),
+                    "RXTX Factor": flv.get("rxtx_factor", 1.0),
+                    "Properties": flv.get("extra_specs", {}),
+                }
+            )
+        return result
+
+    def image_show(self, command):
+        image = self._get("image", f"/v2/images/{command[2]}")
+        self._image_names[image["id"]] = image["name"]
+        return self._image_info(image)
+
+    def _image_info(self, image):
+        result = {k: v for k, v in image.items() if k in IMAGE_ATTRIBUTES}
+        result["properties"] = {
+            k: v for k, v in image.items() if k not in IMAGE_ATTRIBUTES
+        }
+        return result
+
+    def image_list(self, command):
+        # rows also include the properties, as in "image show"
+        result = []
+        for image in self._get_all("image", "/v2/images", "images"):
+            self._image_names[image["id"]] = image["name"]
+            info = self._image_info(image)
+            result.append(
+                {
+                    "ID": image["id"],
+                    "Name": image["name"],
+                    "Disk Format": image.get("disk_format"),
+                    "Container Format": image.get("container_format"),
+                    "Size": image.get("size"),
+                    "Checksum": image.get("checksum"),
+                    "Status": image["status"],
+                    "Visibility": image.get("visibility"),
+                    "Protected": image.get("protected"),
+                    "Project": image.get("owner"),
+                    "Tags": image.get("tags", []),
+                    "properties": info["properties"],
+                }
+            )
+        return result
+
+    def volume_show(self, command):
+        return self._get("block-storage", f"/volumes/{command[2]}")["volume"]
+
+    def volume_list(self, command):
+        params = {}
+        status = _option(command, "--status")
+        if status:
+            params["status"] = status
+        volumes = self._get_all("block-storage", "/volumes/detail", "volumes", **params)
+        # rows also include the image metadata, as in "volume show"
+        return [
+            {
+                "ID": vol["id"],
+                "Name": vol.get("name") or "",
+                "Status": vol["status"],
+                "Size": vol["size"],
+                "Attached to": vol.get("attachments", []),
+                "volume_image_metadata": vol.get("volume_image_metadata", {}),
+            }
+            for vol in volumes
+        ]
+
+    def _image_name(self, image_id):
+        if image_id not in self._image_names:
+            try:
+                self.image_show(("image", "show", image_id))
+            except ClientException:
+                self._image_names[image_id] = ""
+        return self._image_names[image_id]
+
+    def _flavor_name(self, flavor):
+        # microversion 2.47 embeds the flavor in the server
+        if "original_name" in flavor:
+            return flavor["original_name"]
+        flavor_id = flavor.get("id", "")
+        if flavor_id not in self._flavor_names:
+            self.flavor_list(("flavor", "list"))
+            # do not look for it again if not there
+            self._flavor_names.setdefault(flavor_id, flavor_id)
+        return self._flavor_names[flavor_id]
+
+    def _get_all(self, service_type, path, key, **params):
+        """All the items of a list call, going through every page
+
+        Sites may return less than PAGE_SIZE items per page, so pages are
+        requested while the response links to a next one.
+        """
+        items = []
+        params["limit"] = PAGE_SIZE
+        while True:
+            response = self._get(service_type, path, **params)
+            page = response[key]
+            items.extend(page)
+            if not page or not _has_next(response, key):
+                return items
+            params["marker"] = page[-1]["id"]
+
+    def server_list(self, command):
+        params = {}
+        changes_since = _option(command, "--changes-since")
+        if changes_since:
+            params["changes-since"] = changes_since
+        result = []
+        server_details = {}
+        for server in self._get_all("compute", "/servers/detail", "servers", **params):
+            server_details[server["id"]] = self._server_info(server)
+            networks = {
+                net: [addr["addr"] for addr in addrs]
+                for net, addrs in server.get("addresses", {}).items()
+            }
+            image_id = (server.get("image") or {}).get("id", "")
+            image_name = self._image_name(image_id) if image_id else ""
+            result.append(
+                {
+                    "ID": server["id"],
+                    "Name": server["name"],
+                    "Status": server["status"],
+                    "Task State": server.get("OS-EXT-STS:task_state"),
+                    "Power State": server.get("OS-EXT-STS:power_state"),
+                    "Networks": networks,
+                    "Image Name": image_name or IMAGE_STRING_FOR_BFV,
+                    "Image ID": image_id,
+                    "Flavor": self._flavor_name(server.get("flavor", {})),
+                    "Availability Zone": server.get("OS-EXT-AZ:availability_zone"),
+                    "Host": server.get("OS-EXT-SRV-ATTR:hypervisor_hostname"),
+                    "Properties": server.get("metadata", {}),
+                    "Updated": server.get("updated"),
+                }
+            )
+        if not changes_since:
+            self.server_details = server_details
+        return result
+
+    def server_show(self, command):
+        server = self._get("compute", f"/servers/{command[2]}")["server"]
+        return self._server_info(server)
+
+    def _server_info(self, server):
+        info = {
+            "id": server["id"],
+            "name": server["name"],
+            "status": server["status"],
+            "created_at": server["created"],
+            "updated": server.get("updated"),
+            "user_id": server["user_id"],
+            "project_id": server["tenant_id"],
+            "security_groups": server.get("security_groups", []),
+            "attached_volumes": [
+                {"id": vol["id"]}
+                for vol in server.get("os-extended-volumes:volumes_attached", [])
+            ],
+            "properties": server.get("metadata", {}),
+        }
+        # only there if the site supports the requested microversion
+        if "tags" in server:
+            info["tags"] = server["tags"]
+        return info
+
+    def server_delete(self, command):
+        self._api("compute").delete(f"/servers/{command[2]}")
+        return ""
+
+    def security_group_list(self, command):
+        params = {}
+        project_id = _option(command, "--project")
+        if project_id:
+            params["project_id"] = project_id
+        groups = self._get("network", "/v2.0/security-groups", **params)
+        return [
+            {
+                "ID": group["id"],
+                "Name": group["name"],
+                "Description": group.get("description", ""),
+                "Project": group.get("project_id", ""),
+                "Tags": group.get("tags", []),
+            }
+            for group in groups["security_groups"]
+        ]
+
+    def floating_ip_list(self, command):
+        params = {}
+        status = _option(command, "--status")
+        if status:
+            params["status"] = status
+        fips = self._get("network", "/v2.0/floatingips", **params)
+        return [
+            {
+                "ID": fip["id"],
+                "Floating IP Address": fip["floating_ip_address"],
+                "Fixed IP Address": fip.get("fixed_ip_address"),
+                "Port": fip.get("port_id"),
+                "Floating Network": fip.get("floating_network_id"),
+                "Project": fip.get("project_id"),
+            }
+            for fip in fips["floatingips"]
+        ]
+
+    def quota_show(self, command):
+        compute = self._get("compute", f"/os-quota-sets/{self.project_id}/detail")[
+            "quota_set"
+        ]
+        network = self._get("network", f"/v2.0/quotas/{self.project_id}/details")[
+            "quota"
+        ]
+        result = []
+        for name, quota in compute.items():
+            # the network API has the values of the network quotas
+            if isinstance(quota, dict) and name not in COMPUTE_NETWORK_QUOTAS:
+                result.append(
+                    {
+                        "Resource": QUOTA_NAMES.get(name, name.replace("_", "-")),
+                        "Limit": quota["limit"],
+                        "In Use": quota["in_use"],
+                        "Reserved": quota.get("reserved", 0),
+                    }
+                )
+        for name, quota in network.items():
+            result.append(
+                {
+                    "Resource": QUOTA_NAMES.get(name, name.replace("_", "-")),
+                    "Limit": quota["limit"],
+                    "In Use": quota["used"],
+                    "Reserved": quota.get("reserved", 0),
+                }
+            )
+        return result
+
+    def run(self, command):
+        return getattr(self, COMMANDS[command_name(command)])(command)
+
+
+# openstack CLI commands that can be run in-process
+COMMANDS = {
+    ("flavor", "list"): "flavor_list",
+    ("floating", "ip", "list"): "floating_ip_list",
+    ("image", "list"): "image_list",
+    ("image", "show"): "image_show",
+    ("quota", "show"): "quota_show",
+    ("security", "group", "list"): "security_group_list",
+    ("server", "delete"): "server_delete",
+    ("server", "list"): "server_list",
+    ("server", "show"): "server_show",
+    ("token", "issue"): "token_issue",
+    ("user", "list"): "user_list",
+    ("user", "show"): "user_show",
+    ("volume", "list"): "volume_list",
+    ("volume", "show"): "volume_show",
+}
+
+
+def command_name(command):
+    for name in COMMANDS:
+        if tuple(command[: len(name)]) == name:
+            return name
+    return None
+
+
+def supports(command):
+    """True if the command can be run with fedcloud_openstack_api"""
+    return command_name(command) is not None
+
+
+class EndpointResolver:
+    """Endpoint, project ID and protocol of each site and VO
+
+    Every site and VO is looked up only once for the whole run, the number
+    of lookups saved is kept for reporting.
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.saved = 0
+
+    def resolve(self, site, vo):
+        """Same result as fedcloudclient's find_endpoint_and_project_id"""
+        with self._lock:
+            if (site, vo) in self._endpoints:
+                self.saved += 1
+            else:
+                self.lookups += 1
+                self._endpoints[(site, vo)] = find_endpoint_and_project_id(site, vo)
+            return self._endpoints[(site, vo)]
+
+    def report(self):
+        return f"{self.lookups} looked up, {self.saved} lookups saved"
+
+
+resolver = EndpointResolver()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(oidc_access_token, site, vo, domain_id=None):
+    """Get the session for the site and VO, authenticating only once"""
+    key = (site, vo, domain_id)
+    endpoint, project_id, protocol = resolver.resolve(site, vo)
+    if endpoint is None:
+        return None
+    with _sessions_lock:
+        site_session = _sessions.get(key)
+        if site_session is None or site_session.token != oidc_access_token:
+            site_session = SiteSession(
+                oidc_access_token, endpoint, protocol, project_id, domain_id
+            )
+            _sessions[key] = site_session
+        return site_session
+
+
+def get_server_details(oidc_access_token, site, vo):
+    """Details of the servers as returned by "server show", indexed by ID
+
+    They are taken from the last "server list" command run in the session
+    of the site and VO, so no additional calls are needed. The session does
+    not keep them afterwards.
+    """
+    site_session = get_session(oidc_access_token, site, vo)
+    if site_session is None:
+        return {}
+    server_details, site_session.server_details = site_session.server_details, {}
+    return server_details
+
+
+def fedcloud_openstack_api(
+    oidc_access_token, site, vo, openstack_command, json_output=True
+):
+    """
+    Run an openstack command in-process, same interface as fedcloud_openstack
+
+    :return: error code, result or error message
+    """
+    site_session = get_session(
+        oidc_access_token,
+        site,
+        vo,
+        _option(openstack_command, "--os-domain-id"),
+    )
+    if site_session is None:
+        return MISSING_VO_ERROR_CODE, f"VO {vo} not found on site {site}\n"
+    try:
+        return 0, site_session.run(openstack_command)
+    except ClientException as e:
+        return API_ERROR_CODE, str(e)
+
+
+def fedcloud_openstack_cli(
+    oidc_access_token, site, vo, openstack_command, json_output=True
+):
+    """
+    Run an openstack CLI command, same interface as fedcloud_openstack
+
+    The scoped token of the session of the site and VO is reused, so the
+    CLI does not authenticate again. Unscoped commands are run with
+    fedcloud_openstack.
+
+    :return: error code, result or error message
+    """
+    if vo is None:
+        return fedcloud_openstack(
+            oidc_access_token, site, vo, openstack_command, json_output=json_output
+        )
+    site_session = get_session(oidc_access_token, site, vo)
+    if site_session is None:
+        return MISSING_VO_ERROR_CODE, f"VO {vo} not found on site {site}\n"
+    try:
+        # only authenticates again if the token expired
+        token = site_session.session.get_token()
+    except ClientException as e:
+        return API_ERROR_CODE, str(e)
+    options = (
+        "--os-auth-url",
+        site_session.endpoint,
+        "--os-auth-type",
+        "v3token",
+        "--os-token",
+        token,
+        "--os-project-id",
+        site_session.project_id,
+        "--os-compute-api-version",
+        COMPUTE_MICROVERSION,
+    )
+    if json_output:
+        options = options + ("--format", "json")
+    env = os.environ.copy()
+    for name in CONFLICTING_ENVS:
+        env.pop(name, None)
+    try:
+        completed = subprocess.run(  # nosec
+            (OPENSTACK_CLIENT,) + tuple(openstack_command) + options,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+    except OSError as e:
+        # e.g. the openstack client is not installed
+        return API_ERROR_CODE, f"Can not run {OPENSTACK_CLIENT}: {e}"
+    result = completed.stdout.decode("utf-8")
+    if completed.returncode != 0:
+        # some errors are written to stdout
+        return completed.returncode, completed.stderr.decode("utf-8") + result
+    if json_output:
+        try:
+            return 0, json.loads(result)
+        except ValueError:
+            pass
+    return 0, result
@@ -0,0 +1,22 @@
+"""Structured output of the monitoring results"""
+
+import json
+import threading
+
+import click
+
+
+class JSONLinesWriter:
+    """Writes records as JSON Lines, one line per record as soon as it is ready
+
+    Records may be written from several threads at the same time.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            click.echo(line, file=self.file)
@@ -0,0 +1,149 @@
+"""Network probes of the VMs: SSH banner and CUPS port"""
+
+import asyncio
+import threading
+
+SSH_PORT = 22
+CUPS_PORT = 631
+# RFC 4253 allows some lines before the SSH version
+MAX_BANNER_LINES = 10
+
+
+class _UDPProbe(asyncio.DatagramProtocol):
+    def __init__(self, result):
+        self.result = result
+
+    def _set(self, value):
+        if not self.result.done():
+            self.result.set_result(value)
+
+    def connection_made(self, transport):
+        transport.sendto(b"\n")
+
+    def datagram_received(self, data, addr):
+        self._set("open")
+
+    def error_received(self, exc):
+        # ICMP port unreachable is received as connection refused
+        if isinstance(exc, ConnectionRefusedError):
+            self._set("closed")
+        else:
+            self._set(f"error: {exc}")
+
+
+class NetworkProber:
+    """Probes the VMs with asyncio using raw sockets
+
+    All probes run in a single event loop in a background thread, so the
+    concurrency limit is global even if used from several threads.
+    """
+
+    def __init__(self, timeout=5, concurrency=100):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return self._loop
+
+    async def _ssh_banner(self, ip):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, SSH_PORT), self.timeout
+            )
+        except asyncio.TimeoutError:
+            return "could not retrieve SSH version: connection timed out"
+        except OSError as e:
+            return f"could not retrieve SSH version: {e}"
+        try:
+            for _ in range(MAX_BANNER_LINES):
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not line:
+                    break
+                line = line.decode("utf-8", errors="replace").strip()
+                if line.startswith("SSH-"):
+                    return line
+            return "could not retrieve SSH version: no SSH banner"
+        except (asyncio.TimeoutError, OSError):
+            return "could not retrieve SSH version: no SSH banner"
+        finally:
+            writer.close()
+
+    async def _tcp_port(self, ip, port):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, port), self.timeout
+            )
+            writer.close()
+            return "open"
+        except ConnectionRefusedError:
+            return "closed"
+        except asyncio.TimeoutError:
+            return "filtered"
+        except OSError as e:
+            return f"error: {e}"
+
+    async def _udp_port(self, ip, port):
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UDPProbe(result), remote_addr=(ip, port)
+            )
+        except OSError as e:
+            return f"error: {e}"
+        try:
+            return await asyncio.wait_for(result, self.timeout)
+        except asyncio.TimeoutError:
+            # no answer, but nothing saying it is closed either
+            return "open|filtered"
+        finally:
+            transport.close()
+
+    async def _cups(self, ip):
+        tcp, udp = await asyncio.gather(
+            self._tcp_port(ip, CUPS_PORT), self._udp_port(ip, CUPS_PORT)
+        )
+        if tcp == "open" or udp == "open":
+            return "WARNING: CUPS port is open"
+        if udp == "open|filtered":
+            return "WARNING: CUPS UDP port is open or filtered"
+        if tcp in ("closed", "filtered") and udp == "closed":
+            return "CUPS port is closed"
+        return f"Error checking CUPS port. TCP: {tcp}, UDP: {udp}."
+
+    async def _probe_ip(self, ip, ssh, cups):
+        async with self._semaphore:
+            result = {}
+            if ssh:
+                result["ssh"] = await self._ssh_banner(ip)
+            if cups:
+                result["cups"] = await self._cups(ip)
+            return ip, result
+
+    async def _probe(self, ips, ssh, cups):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(
+            *[self._probe_ip(ip, ssh, cups) for ip in set(ips)]
+        )
+        return dict(results)
+
+    def probe(self, ips, ssh=True, cups=True):
+        """Probes all the IPs in one batch
+
+        Returns a dict with the results for each IP, with "ssh" containing the
+        SSH banner and "cups" the status of the CUPS port.
+        """
+        if not ips:
+            return {}
+        future = asyncio.run_coroutine_threadsafe(
+            self._probe(ips, ssh, cups), self._start()
+        )
+        return future.result()
@@ -0,0 +1,138 @@
+"""Timing of the calls to external services
+
+The module level profiler is disabled by default, so timing hooks cost
+nothing unless profiling is requested.
+"""
+
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# number of individual calls shown in the report
+SLOWEST_CALLS = 10
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the values"""
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def _stats(durations):
+    return {
+        "calls": len(durations),
+        "total": sum(durations),
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+    }
+
+
+class Profiler:
+    """Collects the duration of every call of each operation"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._calls = []
+
+    @contextmanager
+    def timed(self, operation, site=None, detail=None):
+        """Times the block as a call of the operation at the site"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._calls.append((operation, site, detail, elapsed))
+
+    def summary(self):
+        """Statistics per operation and per site, and the slowest calls"""
+        with self._lock:
+            calls = list(self._calls)
+        operations = defaultdict(list)
+        sites = defaultdict(list)
+        for operation, site, _, elapsed in calls:
+            operations[operation].append(elapsed)
+            if site:
+                sites[(site, operation)].append(elapsed)
+        slowest = sorted(calls, key=lambda call: call[3], reverse=True)
+        return {
+            "operations": [
+                dict(operation=operation, **_stats(durations))
+                for operation, durations in sorted(operations.items())
+            ],
+            "sites": [
+                dict(site=site, operation=operation, **_stats(durations))
+                for (site, operation), durations in sorted(sites.items())
+            ],
+            "slowest": [
+                {
+                    "operation": operation,
+                    "site": site,
+                    "detail": detail,
+                    "seconds": elapsed,
+                }
+                for operation, site, detail, elapsed in slowest[:SLOWEST_CALLS]
+            ],
+        }
+
+    def report(self, report_format="table"):
+        """Report of the summary as a JSON document or as text tables"""
+        summary = self.summary()
+        if report_format == "json":
+            return json.dumps(summary)
+        lines = ["[.] Time per operation:", self._header("operation")]
+        for stats in summary["operations"]:
+            lines.append(self._stats_line(stats["operation"], stats))
+        lines.extend(["[.] Time per site:", self._header("site / operation")])
+        for stats in summary["sites"]:
+            name = f"{stats['site']} / {stats['operation']}"
+            lines.append(self._stats_line(name, stats))
+        lines.append("[.] Slowest calls:")
+        for call in summary["slowest"]:
+            where = f" at {call['site']}" if call["site"] else ""
+            detail = f" ({call['detail']})" if call["detail"] else ""
+            lines.append(
+                f"    {call['seconds']:8.3f}s {call['operation']}{where}{detail}"
+            )
+        return "\n".join(lines)
+
+    def _header(self, name):
+        return f"    {name:<40} {'calls':>6} {'total':>9} {'p50':>8} {'p95':>8}"
+
+    def _stats_line(self, name, stats):
+        return (
+            f"    {name:<40} {stats['calls']:>6} {stats['total']:>8.3f}s "
+            f"{stats['p50']:>7.3f}s {stats['p95']:>7.3f}s"
+        )
+
+
+profiler = Profiler()
+
+
+def profiled(operation):
+    """Decorator timing every call as the operation
+
+    The site of the call is taken from the site attribute of the object of
+    the method, if any.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            site = getattr(args[0], "site", None) if args else None
+            if not isinstance(site, str):
+                site = None
+            with profiler.timed(operation, site=site):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
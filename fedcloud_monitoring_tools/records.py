@@ -0,0 +1,192 @@
+"""Information of the VMs and how it is shown"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+import click
+
+STATUS_COLORS = defaultdict(lambda: "red", ACTIVE="green", BUILD="yellow")
+
+
+class VMRecord:
+    """Information of a VM found at a site
+
+    Only the values are kept, the text and JSON representations are built
+    when the record is shown. Optional values are None when not checked or
+    not known. Tags and orchestrator are kept for the deletion policy, so
+    the details of the VM are not needed once the record is built.
+    """
+
+    __slots__ = (
+        "id",
+        "name",
+        "status",
+        "ips",
+        "security_groups",
+        "ssh_version",
+        "cups",
+        "flavor_name",
+        "vcpus",
+        "ram_gb",
+        "disk_gb",
+        "image",
+        "created_at",
+        "elapsed",
+        "over_max_days",
+        "user_id",
+        "egi_user",
+        "email",
+        "im_id",
+        "tags",
+        "orchestrator",
+    )
+
+    def __init__(
+        self,
+        id,
+        name,
+        status,
+        ips=(),
+        security_groups=(),
+        ssh_version=None,
+        cups=None,
+        flavor_name=None,
+        vcpus=None,
+        ram_gb=None,
+        disk_gb=None,
+        image="",
+        created_at="",
+        elapsed=timedelta(0),
+        over_max_days=False,
+        user_id="",
+        egi_user=None,
+        email=None,
+        im_id=None,
+        tags=None,
+        orchestrator=None,
+    ):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.ips = tuple(ips)
+        self.security_groups = tuple(sorted(security_groups))
+        self.ssh_version = ssh_version
+        self.cups = cups
+        self.flavor_name = flavor_name
+        self.vcpus = vcpus
+        self.ram_gb = ram_gb
+        self.disk_gb = disk_gb
+        self.image = image
+        self.created_at = created_at
+        self.elapsed = elapsed
+        self.over_max_days = over_max_days
+        self.user_id = user_id
+        self.egi_user = egi_user
+        self.email = email
+        self.im_id = im_id
+        self.tags = None if tags is None else tuple(tags)
+        self.orchestrator = orchestrator
+
+    def to_dict(self):
+        """JSON representation of the record, without the unknown values
+
+        tags is always there, null if the site does not return them.
+        """
+        record = {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "ips": list(self.ips),
+            "security_groups": list(self.security_groups),
+        }
+        if self.ssh_version is not None:
+            record["ssh_version"] = self.ssh_version
+        if self.cups is not None:
+            record["cups"] = self.cups
+        if self.flavor_name is not None:
+            record["flavor"] = {
+                "name": self.flavor_name,
+                "vcpus": self.vcpus,
+                "ram_gb": self.ram_gb,
+                "disk_gb": self.disk_gb,
+            }
+        record["image"] = self.image
+        record["created_at"] = self.created_at
+        record["elapsed_seconds"] = self.elapsed.total_seconds()
+        record["over_max_days"] = self.over_max_days
+        record["user_id"] = self.user_id
+        if self.egi_user is not None:
+            record["egi_user"] = self.egi_user
+            record["email"] = self.email
+        if self.im_id is not None:
+            record["im_id"] = self.im_id
+        record["tags"] = None if self.tags is None else list(self.tags)
+        if self.orchestrator is not None:
+            record["orchestrator"] = self.orchestrator
+        return record
+
+    @classmethod
+    def from_dict(cls, record):
+        """Record from its JSON representation"""
+        flavor = record.get("flavor") or {}
+        return cls(
+            record["id"],
+            record["name"],
+            record["status"],
+            ips=record.get("ips", ()),
+            security_groups=record.get("security_groups", ()),
+            ssh_version=record.get("ssh_version"),
+            cups=record.get("cups"),
+            flavor_name=flavor.get("name"),
+            vcpus=flavor.get("vcpus"),
+            ram_gb=flavor.get("ram_gb"),
+            disk_gb=flavor.get("disk_gb"),
+            image=record.get("image", ""),
+            created_at=record.get("created_at", ""),
+            elapsed=timedelta(seconds=record.get("elapsed_seconds", 0)),
+            over_max_days=record.get("over_max_days", False),
+            user_id=record.get("user_id", ""),
+            egi_user=record.get("egi_user"),
+            email=record.get("email"),
+            im_id=record.get("im_id"),
+            tags=record.get("tags"),
+            orchestrator=record.get("orchestrator"),
+        )
+
+
+def render_text(record):
+    """List of (label, value) to show the VM record as text"""
+    output = [
+        ("instance name", record.name),
+        ("instance id", record.id),
+        ("status", click.style(record.status, fg=STATUS_COLORS[record.status])),
+        ("ip address", " ".join(record.ips)),
+        ("sec. groups", set(record.security_groups)),
+    ]
+    if record.ssh_version is not None:
+        output.append(("SSH version", record.ssh_version))
+    if record.cups is not None:
+        output.append(("CUPS", record.cups))
+    if record.flavor_name is not None:
+        output.append(
+            (
+                "flavor",
+                f"{record.flavor_name} with {record.vcpus} vCPU cores, "
+                f"{record.ram_gb} GB of RAM and {record.disk_gb} GB of local disk",
+            )
+        )
+    output.append(("VM image", record.image))
+    output.append(("created at", record.created_at))
+    output.append(("elapsed time", record.elapsed))
+    output.append(("user", record.user_id))
+    if record.egi_user is not None:
+        output.append(("egi user", record.egi_user))
+        output.append(("email", record.email))
+    if record.im_id is not None:
+        output.append(("IM id", record.im_id))
+    return output
+
+
+def render_json(record):
+    """Fields of the vm record of the JSON output"""
+    return record.to_dict()
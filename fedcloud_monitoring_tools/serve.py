@@ -0,0 +1,138 @@
+"""Long-running monitoring of the sites, with the results as metrics"""
+
+import heapq
+import io
+import random
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import click
+from fedcloud_monitoring_tools.site_monitor import (
+    SiteMonitorException,
+    quota_resource_name,
+)
+
+
+def scan_site(site_monitor, show_quotas, registry, get_token=None):
+    """Checks the site again and replaces its samples in the registry
+
+    A new access token is taken from get_token, if given, before the checks.
+    Returns the error message of the checks, if any.
+    """
+    start = time.monotonic()
+    samples = []
+    error = None
+    try:
+        if get_token:
+            # access tokens expire long before the daemon stops, the new one
+            # is needed before the audits start
+            site_monitor.token = get_token()
+        site_monitor.reset()
+        site_monitor.start_audits(show_quotas)
+        # the text output is not shown, only the metrics
+        site_monitor.output = io.StringIO()
+        records = site_monitor.vm_monitor()
+        for status, count in Counter(r.status for r in records).items():
+            samples.append(("fedcloud_vo_monitor_vms", {"status": status}, count))
+        samples.append(
+            (
+                "fedcloud_vo_monitor_vms_over_max_days",
+                {},
+                sum(1 for r in records if r.over_max_days),
+            )
+        )
+        quota_info = site_monitor.show_quotas() if show_quotas else {}
+        if show_quotas:
+            for resource, quota in quota_info.items():
+                labels = {"resource": quota_resource_name(resource)}
+                samples.append(
+                    ("fedcloud_vo_monitor_quota_limit", labels, quota["Limit"])
+                )
+                samples.append(
+                    ("fedcloud_vo_monitor_quota_in_use", labels, quota["In Use"])
+                )
+        floating_ips = site_monitor.check_unused_floating_ips()
+        samples.append(
+            ("fedcloud_vo_monitor_unused_floating_ips", {}, len(floating_ips))
+        )
+        security_groups = site_monitor.check_unused_security_groups()
+        samples.append(
+            ("fedcloud_vo_monitor_unused_security_groups", {}, len(security_groups))
+        )
+        volumes = site_monitor.check_unused_volumes()
+        samples.append(("fedcloud_vo_monitor_unused_volumes", {}, len(volumes)))
+        samples.append(
+            (
+                "fedcloud_vo_monitor_unused_volumes_gb",
+                {},
+                sum(vol["Size"] for vol in volumes),
+            )
+        )
+        site_monitor.save_history(records, quota_info, floating_ips, volumes)
+    except SiteMonitorException as e:
+        error = str(e)
+    except SystemExit as e:
+        # raised by fedcloudclient when no valid access token can be obtained
+        error = str(e)
+    except Exception as e:
+        # the samples of the previous scan must not be served as a success
+        error = f"{type(e).__name__}: {e}"
+    samples.append(
+        ("fedcloud_vo_monitor_scan_duration_seconds", {}, time.monotonic() - start)
+    )
+    samples.append(("fedcloud_vo_monitor_scan_success", {}, int(error is None)))
+    samples.append(("fedcloud_vo_monitor_last_scan_timestamp_seconds", {}, time.time()))
+    registry.set_samples(site_monitor.site, site_monitor.vo, samples)
+    return error
+
+
+def serve_sites(site_monitors, scan, interval, jitter=0, workers=1):
+    """Scans every site forever, each one on its own schedule
+
+    Sites are first scanned at a random time within the jitter, and then
+    again interval seconds (plus a random jitter) after their last scan
+    finished. At most workers sites are scanned at the same time.
+    """
+    if not site_monitors:
+        return
+    queue = [
+        (time.monotonic() + random.uniform(0, jitter), i)
+        for i in range(len(site_monitors))
+    ]
+    heapq.heapify(queue)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while queue and queue[0][0] <= time.monotonic():
+                _, i = heapq.heappop(queue)
+                running[executor.submit(scan, site_monitors[i])] = i
+            timeout = max(0, queue[0][0] - time.monotonic()) if queue else None
+            if not running:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                site_monitor = site_monitors[i]
+                try:
+                    error = future.result()
+                except Exception as e:
+                    # keep on scanning the rest of the sites
+                    error = f"{type(e).__name__}: {e}"
+                if error:
+                    click.echo(
+                        " ".join(
+                            [
+                                click.style("ERROR:", fg="red"),
+                                f"{site_monitor.site}: {error}",
+                            ]
+                        ),
+                        err=True,
+                    )
+                else:
+                    click.echo(
+                        f"[.] Checked VO {site_monitor.vo} at {site_monitor.site}"
+                    )
+                next_scan = time.monotonic() + interval + random.uniform(0, jitter)
+                heapq.heappush(queue, (next_scan, i))
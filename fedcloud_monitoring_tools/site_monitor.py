@@ -1,35 +1,184 @@
 """Monitor VM instances running in the provider"""
 
 import ipaddress
-import subprocess
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 
 import click
 import ldap3
-import paramiko
 from dateutil.parser import parse
-from fedcloudclient.openstack import fedcloud_openstack
-from fedcloudclient.sites import find_endpoint_and_project_id
+from fedcloud_monitoring_tools import openstack_api
+from fedcloud_monitoring_tools.cache import MetadataCache
+from fedcloud_monitoring_tools.history import run_summary
+from fedcloud_monitoring_tools.probe import NetworkProber
+from fedcloud_monitoring_tools.profiling import profiled, profiler
+from fedcloud_monitoring_tools.records import VMRecord, render_json, render_text
 from ldap3.core.exceptions import LDAPException
-from paramiko import SSHException
+from ldap3.utils.conv import escape_filter_chars
+
+# maximum number of VMs to get only the emails of their owners in "auto" mode
+LDAP_TARGETED_MAX_USERS = 200
+# number of users searched at once in a single LDAP filter
+LDAP_FILTER_BATCH = 50
+LDAP_PAGE_SIZE = 500
 
 
 class SiteMonitorException(Exception):
     pass
 
 
+def quota_resource_name(name):
+    """Name of the quota resource in records and metrics"""
+    return name.replace(" (GB)", "_gb")
+
+
+def os_name_from_properties(properties):
+    """OS name and version from the image properties, None if not there"""
+    for name, version in [("sl:osname", "sl:osversion"), ("os_distro", "os_version")]:
+        if name in properties and version in properties:
+            return f"{properties[name]} {properties[version]}"
+    return None
+
+
+class SingleFlight:
+    """Runs each named fetch only once, concurrent callers share its result
+
+    Results are kept for the rest of the run. Fetch functions are expected to
+    deal with their own errors, so failed fetches are not repeated either.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._results = {}
+
+    def run(self, name, fetch):
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._results:
+                self._results[name] = fetch()
+            return self._results[name]
+
+    def forget(self, name):
+        """Drops the result of the fetch, so it is run again when needed"""
+        with self._lock:
+            self._results.pop(name, None)
+
+
+class UserDirectory:
+    """Users of the sites and their emails, shared by the monitors of a run
+
+    The users do not depend on the VO being checked, they are listed once
+    per site. The emails found in LDAP depend on the search filter, which
+    may include the VO, so they are kept by filter and looked up once for
+    all the sites.
+    """
+
+    def __init__(self):
+        self.site_users = defaultdict(dict)
+        self.user_emails = defaultdict(dict)
+        self.fetches = SingleFlight()
+
+
+class ImageResolver:
+    """Resolves image properties and volume image metadata of a site
+
+    When preloading, the image and volume lists are fetched once and indexed
+    by ID. Single image or volume show commands are only used for IDs not in
+    those lists and their results are kept for the rest of the run.
+    """
+
+    def __init__(self, site_monitor, preload=False):
+        self.site_monitor = site_monitor
+        self.preload = preload
+        self.images = {}
+        self.volumes = {}
+        self._fetches = SingleFlight()
+
+    def _load(self):
+        if not self.preload:
+            return
+        cache = self.site_monitor.cache
+        cache_key = self.site_monitor.cache_key
+        images = cache.get("images", cache_key)
+        if images is None:
+            images = {}
+            for image in self.site_monitor._run_command(
+                ("image", "list", "--long"), do_raise=False
+            ):
+                if "properties" in image:
+                    images[image["ID"]] = image["properties"]
+            cache.set("images", cache_key, images)
+        self.images.update(images)
+        for volume in self.site_monitor._run_command(
+            ("volume", "list", "--long"), do_raise=False
+        ):
+            if "volume_image_metadata" in volume:
+                self.volumes[volume["ID"]] = volume["volume_image_metadata"]
+
+    def _show(self, table, key, command, field):
+        try:
+            result = self.site_monitor._run_command(command)
+            table[key] = result.get(field) or {}
+        except SiteMonitorException:
+            # do not try again
+            table[key] = None
+
+    def _lookup(self, table_name, key, command, field):
+        self._fetches.run("tables", self._load)
+        table = getattr(self, table_name)
+        if key not in table:
+            self._fetches.run(
+                (table_name, key), lambda: self._show(table, key, command, field)
+            )
+        return table[key]
+
+    def image_properties(self, image_id):
+        """Properties of the image, None if the image can not be found"""
+        return self._lookup(
+            "images", image_id, ("image", "show", image_id), "properties"
+        )
+
+    def volume_image_metadata(self, volume_id):
+        """Image metadata of the volume, None if the volume can not be found"""
+        return self._lookup(
+            "volumes",
+            volume_id,
+            ("volume", "show", volume_id),
+            "volume_image_metadata",
+        )
+
+
 class SiteMonitor:
     """Helper class to call fedcloudclient easily"""
 
-    color_maps = defaultdict(lambda: "red", ACTIVE="green", BUILD="yellow")
     # at least 1GB per core
     min_ram_cpu_ratio = 1
     min_secgroup_instance_ratio = 3
     min_ip_instance_ratio = 1
 
     def __init__(
-        self, site, vo, token, max_days, check_ssh, check_cups, ldap_config={}
+        self,
+        site,
+        vo,
+        token,
+        max_days,
+        check_ssh,
+        check_cups,
+        ldap_config={},
+        output=None,
+        vm_workers=1,
+        backend="cli",
+        bulk_details=False,
+        cache=None,
+        prober=None,
+        writer=None,
+        state=None,
+        directory=None,
+        history=None,
     ):
         self.site = site
         self.vo = vo
@@ -37,87 +186,186 @@ class SiteMonitor:
         self.max_days = max_days
         self.check_ssh = check_ssh
         self.check_cups = check_cups
+        self.prober = prober or NetworkProber()
+        self.probe_results = {}
         self.ldap_config = ldap_config
         self.flavors = {}
-        self.users = defaultdict(lambda: {})
-        self.user_emails = {}
+        # users and emails may be shared with the monitors of other VOs
+        self.directory = directory or UserDirectory()
+        self.users = self.directory.site_users[site]
+        self.user_emails = self.directory.user_emails[self._search_filter()]
+        self.cache = cache or MetadataCache(enabled=False)
+        self.cache_key = (site, vo)
+        # lazy caches may be filled from several process_vm workers, each
+        # fetch is done only once per run, even if it fails
+        self._fetches = SingleFlight()
+        # information of the site audits being fetched in the background
+        self._audits = {}
+        self.vm_workers = vm_workers
+        # "cli" runs the openstack client, "api" calls the APIs in-process
+        self.backend = backend
+        # get the details of every VM with the server list (api backend only)
+        self.bulk_details = bulk_details and backend == "api"
+        self.vm_details = {}
+        # image and volume lists include the image properties only in the api
+        self.image_resolver = ImageResolver(self, preload=backend == "api")
+        self.now = datetime.now(timezone.utc)
+        self.used_security_groups = set()
+        # file-like object to write to, stdout if None
+        self.output = output
+        # writer of structured records, text output is used if None
+        self.writer = writer
+        # store of the VMs processed in the last run, every VM is processed
+        # again if None
+        self.state = state
+        self.reused_vms = {}
+        self.vm_states = {}
+        # store of the results of every run, not kept if None
+        self.history = history
+
+    def reset(self):
+        """Prepares the monitor to check the site again
+
+        Information about the VMs of the last check is dropped. Metadata is
+        looked up again, from the cache if still valid, so the users, emails
+        and flavors already in memory are only updated.
+        """
         self.now = datetime.now(timezone.utc)
+        self.probe_results = {}
+        self._fetches = SingleFlight()
+        for name in ("users", "fresh users"):
+            self.directory.fetches.forget((name, self.site))
+        self.directory.fetches.forget(("user emails", self._search_filter()))
+        self._audits = {}
+        self.vm_details = {}
+        self.image_resolver = ImageResolver(self, preload=self.backend == "api")
         self.used_security_groups = set()
+        self.reused_vms = {}
+        self.vm_states = {}
+
+    def _text_file(self):
+        # keep text apart from the records written to stdout
+        if self.output is None and self.writer is not None:
+            return click.get_text_stream("stderr")
+        return self.output
+
+    def echo(self, message=None, **kwargs):
+        # keep the styles when buffering, they are removed on the final echo
+        # if the terminal does not support them
+        color = True if self.output is not None else None
+        click.echo(message, file=self._text_file(), color=color, **kwargs)
+
+    def emit(self, record_type, **fields):
+        """Writes a record of the site if there is a writer, True if written"""
+        if self.writer is None:
+            return False
+        self.writer.write(dict(type=record_type, site=self.site, vo=self.vo, **fields))
+        return True
+
+    def secho(self, message=None, **styles):
+        self.echo(click.style(message, **styles))
 
     def _run_command(self, command, do_raise=True, json_output=True, scoped=True):
         vo = self.vo if scoped else None
-        error_code, result = fedcloud_openstack(
-            self.token, self.site, vo, command, json_output=json_output
-        )
+        if self.backend == "api" and openstack_api.supports(command):
+            run_openstack = openstack_api.fedcloud_openstack_api
+        else:
+            run_openstack = openstack_api.fedcloud_openstack_cli
+        name = openstack_api.command_name(command) or command[:2]
+        with profiler.timed(
+            " ".join(("openstack",) + tuple(name)),
+            site=self.site,
+            detail=" ".join(command),
+        ):
+            error_code, result = run_openstack(
+                self.token, self.site, vo, command, json_output=json_output
+            )
         if error_code != 0:
             if do_raise:
                 raise SiteMonitorException(result)
             else:
-                click.echo(" ".join([click.style("WARNING:", fg="yellow"), result]))
+                self.echo(" ".join([click.style("WARNING:", fg="yellow"), result]))
                 return {}
         return result
 
     def get_user(self, user_id):
-        if not self.users:
-            all_users = []
+        fetches = self.directory.fetches
+        from_cache = fetches.run(("users", self.site), self._load_users)
+        if user_id not in self.users and from_cache:
+            # new user since the list was cached, get a fresh one
+            fetches.run(("fresh users", self.site), self._fetch_users)
+        return self.users.get(user_id, {})
+
+    def _load_users(self):
+        """Gets users from the cache or the site, True if from the cache"""
+        # the user directory of a site is the same for all its VOs
+        all_users = self.cache.get("users", self.site)
+        if all_users is None:
+            self._fetch_users()
+            return False
+        self.users.update({user["ID"]: user for user in all_users})
+        return True
+
+    def _fetch_users(self):
+        all_users = self._get_all_users()
+        if all_users:
+            self.cache.set("users", self.site, all_users)
+        for user in all_users:
+            self.users.setdefault(user["ID"], user)
+
+    def _get_all_users(self):
+        all_users = []
+        try:
+            command = ("user", "list")
+            all_users = self._run_command(command)
+        except SiteMonitorException:
             try:
-                command = ("user", "list")
-                all_users = self._run_command(command)
-            except SiteMonitorException:
-                try:
-                    # trick fedcloudclient to give us what we need
-                    command = ("token", "issue")
-                    token = self._run_command(command, scoped=False)
-                    command = ("user", "show", token["user_id"])
-                    my_user = self._run_command(command, scoped=True)
-                    # now we have the domain, can get all users
-                    command = ("user", "list", "--os-domain-id", my_user["domain_id"])
-                    all_users = self._run_command(command, scoped=False)
-                except SiteMonitorException as e:
-                    click.secho(f"WARNING: Unable to get user list: {e}", fg="yellow")
-            for user in all_users:
-                self.users[user["ID"]] = user
-        return self.users[user_id]
+                # trick fedcloudclient to give us what we need
+                command = ("token", "issue")
+                token = self._run_command(command, scoped=False)
+                command = ("user", "show", token["user_id"])
+                my_user = self._run_command(command, scoped=True)
+                # now we have the domain, can get all users
+                command = ("user", "list", "--os-domain-id", my_user["domain_id"])
+                all_users = self._run_command(command, scoped=False)
+            except SiteMonitorException as e:
+                self.secho(f"WARNING: Unable to get user list: {e}", fg="yellow")
+        return all_users
 
     def get_flavor(self, flavor_name):
-        if flavor_name in self.flavors:
-            return self.flavors[flavor_name]
+        from_cache = self._fetches.run("flavors", self._load_flavors)
+        if flavor_name not in self.flavors and from_cache:
+            # new flavor since the list was cached, get a fresh one
+            self._fetches.run("fresh flavors", self._fetch_flavors)
+        return self.flavors.get(flavor_name, {})
+
+    def _load_flavors(self):
+        """Gets flavors from the cache or the site, True if from the cache"""
+        flavors = self.cache.get("flavors", self.cache_key)
+        if flavors is None:
+            self._fetch_flavors()
+            return False
+        self.flavors.update(flavors)
+        return True
+
+    def _fetch_flavors(self):
         command = ("flavor", "list", "--long")
-        result = self._run_command(command)
-        for flv in result:
-            self.flavors[flv["Name"]] = flv
-        if flavor_name not in self.flavors:
-            return {}
-        return self.flavors[flavor_name]
+        try:
+            result = self._run_command(command)
+        except SiteMonitorException as e:
+            self.secho(f"WARNING: Unable to get flavor list: {e}", fg="yellow")
+            return
+        self.flavors.update({flv["Name"]: flv for flv in result})
+        self.cache.set("flavors", self.cache_key, self.flavors)
 
     def get_vm_image_volume_show(self, volume_id):
-        try:
-            cmd = ("volume", "show", volume_id)
-            result = self._run_command(cmd)
-            if ("volume_image_metadata" in result) and (
-                "sl:osname" and "sl:osversion" in result["volume_image_metadata"]
-            ):
-                return (
-                    result["volume_image_metadata"]["sl:osname"]
-                    + " "
-                    + result["volume_image_metadata"]["sl:osversion"]
-                )
-            elif ("volume_image_metadata" in result) and (
-                "os_distro" and "os_version" in result["volume_image_metadata"]
-            ):
-                return (
-                    result["volume_image_metadata"]["os_distro"]
-                    + " "
-                    + result["volume_image_metadata"]["os_version"]
-                )
-            elif ("volume_image_metadata" in result) and (
-                "image_name" in result["volume_image_metadata"]
-            ):
-                return result["volume_image_metadata"]["image_name"]
-            else:
-                return "image name not found"
-        except SiteMonitorException:
+        metadata = self.image_resolver.volume_image_metadata(volume_id)
+        if metadata is None:
             return "image name not found"
+        os_name = os_name_from_properties(metadata)
+        if os_name:
+            return os_name
+        return metadata.get("image_name", "image name not found")
 
     def get_vm_image(self, vm_id, image_name, image_id, attached_volumes):
         """Commands to get VM images:
@@ -130,6 +378,9 @@ class SiteMonitor:
         3a. openstack server show <vm-id>
         3b. openstack volume show <volume-id>
 
+        Image and volume details are resolved with the image_resolver, so
+        they are only fetched once per site.
+
         Parameters
         ----------
         vm_id: str
@@ -146,78 +397,170 @@ class SiteMonitor:
         """
         if (len(image_name) > 0) and ("booted from volume" not in image_name):
             return image_name
-        else:
-            # check image properties with "openstack image show"
-            try:
-                cmd = ("image", "show", image_id)
-                result = self._run_command(cmd)
-                if "sl:osname" and "sl:osversion" in result["properties"]:
-                    return (
-                        result["properties"]["sl:osname"]
-                        + " "
-                        + result["properties"]["sl:osversion"]
-                    )
-                elif "os_distro" and "os_version" in result["properties"]:
-                    return (
-                        result["properties"]["os_distro"]
-                        + " "
-                        + result["properties"]["os_version"]
-                    )
-                else:
-                    # check volumes attached
-                    if len(attached_volumes) > 0:
-                        return self.get_vm_image_volume_show(attached_volumes[0]["id"])
-                    else:
-                        return "image name not found"
-            except SiteMonitorException:
-                if len(attached_volumes) > 0:
-                    return self.get_vm_image_volume_show(attached_volumes[0]["id"])
-                else:
-                    return "image not found"
+        # check image properties as in "openstack image show"
+        properties = self.image_resolver.image_properties(image_id)
+        if properties is not None:
+            os_name = os_name_from_properties(properties)
+            if os_name:
+                return os_name
+        # check volumes attached
+        if len(attached_volumes) > 0:
+            return self.get_vm_image_volume_show(attached_volumes[0]["id"])
+        if properties is not None:
+            return "image name not found"
+        return "image not found"
 
     def get_vms(self):
         command = ("server", "list", "--long")
-        return self._run_command(command)
+        vms = self._run_command(command)
+        if self.bulk_details:
+            self.vm_details = openstack_api.get_server_details(
+                self.token, self.site, self.vo
+            )
+        return vms
+
+    def list_vms(self):
+        """ID, name and status of the VMs of the site"""
+        return self._run_command(("server", "list"))
 
     def get_vm(self, vm):
-        command = ("server", "show", vm["ID"])
-        return self._run_command(command)
+        if vm["ID"] not in self.vm_details:
+            command = ("server", "show", vm["ID"])
+            self.vm_details[vm["ID"]] = self._run_command(command)
+        return self.vm_details[vm["ID"]]
 
-    def delete_vm(self, vm):
-        click.echo(
+    def delete_vm(self, vm, do_raise=False):
+        self.echo(
             f"[-] Deleting of the instance [{click.style(vm['ID'], fg='red')}] in progress..."
         )
         command = ("server", "delete", vm["ID"])
         # this won't work as it does not accept a --json option :(
-        self._run_command(command, do_raise=False, json_output=False)
+        self._run_command(command, do_raise=do_raise, json_output=False)
 
     def get_user_email(self, egi_user):
         if not self.ldap_config:
             return ""
-        # TODO: this is untested code
-        if not self.user_emails:
-            try:
-                # get the emails
-                server = ldap3.Server(self.ldap_config["server"], get_info=ldap3.ALL)
-                conn = ldap3.Connection(
-                    server,
-                    self.ldap_config["username"],
-                    password=self.ldap_config["password"],
-                    auto_bind=True,
-                )
-                conn.search(
-                    self.ldap_config["base_dn"],
-                    self.ldap_config["search_filter"],
-                    attributes=["*"],
-                )
-                for entry in conn.entries:
-                    self.user_emails[entry["voPersonID"].value] = entry["mail"].value
-            except LDAPException as e:
-                click.secho(f"WARNING: LDAP error: {e}", fg="yellow")
+        # all the entries are fetched only once for all the sites with the filter
+        self._fetches.run(
+            "user emails",
+            lambda: self.directory.fetches.run(
+                ("user emails", self._search_filter()), self._fetch_user_emails
+            ),
+        )
         if egi_user not in self.user_emails:
             return f"{egi_user} not found in LDAP, has VO membership expired?"
         return self.user_emails[egi_user]
 
+    def _targeted_emails(self, vms):
+        """True if only the emails of the owners of the VMs are searched"""
+        if not self.ldap_config:
+            return False
+        mode = self.ldap_config.get("mode", "auto")
+        if mode == "auto":
+            return len(vms) <= LDAP_TARGETED_MAX_USERS
+        return mode == "targeted"
+
+    def missing_details(self, vms):
+        """VMs whose details are needed before processing them"""
+        if not self._targeted_emails(vms):
+            return []
+        return [vm for vm in vms if vm["ID"] not in self.vm_details]
+
+    def prefetch_user_emails(self, vms, bar=None):
+        """Gets from LDAP only the emails of the owners of the VMs
+
+        Used instead of getting all the entries of the VO when there are few
+        VMs to check or when the LDAP mode is "targeted". The owners are
+        taken from the VM details, already there with bulk details. Missing
+        ones are fetched with the VM workers, counted in bar, and kept for
+        process_vm, so this does not add any call to the site.
+        """
+        if not self._targeted_emails(vms):
+            return
+        missing = self.missing_details(vms)
+        if self.vm_workers > 1 and len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=self.vm_workers) as executor:
+                for _ in executor.map(self.get_vm, missing):
+                    if bar is not None:
+                        bar.update(1)
+        else:
+            for vm in missing:
+                self.get_vm(vm)
+                if bar is not None:
+                    bar.update(1)
+        owners = set()
+        for vm in vms:
+            name = self.get_user(self.get_vm(vm)["user_id"]).get("Name", None)
+            if name:
+                owners.add(name)
+        # owners already found for another site are not searched again
+        owners -= set(self.user_emails)
+        self._fetches.run(
+            "user emails", lambda: owners and self._fetch_user_emails(owners)
+        )
+
+    def _search_filter(self):
+        """LDAP search filter of the VO members, {vo} is replaced by the VO"""
+        return self.ldap_config.get("search_filter", "").replace("{vo}", self.vo)
+
+    def _add_user_emails(self, attributes):
+        # attributes may be single or multi-valued
+        ids = attributes.get("voPersonID", [])
+        mails = attributes.get("mail", [])
+        ids = ids if isinstance(ids, list) else [ids]
+        mails = mails if isinstance(mails, list) else [mails]
+        if mails:
+            for egi_user in ids:
+                self.user_emails[egi_user] = mails[0]
+
+    @profiled("ldap search")
+    def _fetch_user_emails(self, egi_users=None):
+        """Gets the voPersonID to mail mapping from LDAP
+
+        If egi_users is given, only those users are searched in batches,
+        otherwise all the entries of the search filter are fetched in pages.
+        """
+        # TODO: this is untested code
+        base_dn = self.ldap_config["base_dn"]
+        search_filter = self._search_filter()
+        attributes = ["voPersonID", "mail"]
+        try:
+            # get the emails
+            server = ldap3.Server(self.ldap_config["server"], get_info=ldap3.ALL)
+            conn = ldap3.Connection(
+                server,
+                self.ldap_config["username"],
+                password=self.ldap_config["password"],
+                auto_bind=True,
+            )
+            if egi_users is None:
+                entries = conn.extend.standard.paged_search(
+                    base_dn,
+                    search_filter,
+                    attributes=attributes,
+                    paged_size=LDAP_PAGE_SIZE,
+                    generator=True,
+                )
+            else:
+                entries = []
+                egi_users = sorted(egi_users)
+                for i in range(0, len(egi_users), LDAP_FILTER_BATCH):
+                    users_filter = "".join(
+                        f"(voPersonID={escape_filter_chars(egi_user)})"
+                        for egi_user in egi_users[i : i + LDAP_FILTER_BATCH]
+                    )
+                    conn.search(
+                        base_dn,
+                        f"(&{search_filter}(|{users_filter}))",
+                        attributes=attributes,
+                    )
+                    entries.extend(conn.response)
+            for entry in entries:
+                if entry["type"] == "searchResEntry":
+                    self._add_user_emails(entry["attributes"])
+        except LDAPException as e:
+            self.secho(f"WARNING: LDAP error: {e}", fg="yellow")
+
     def get_public_ip(self, ip_addresses):
         result = ""
         for ip in ip_addresses:
@@ -225,192 +568,330 @@ class SiteMonitor:
                 result = ip
         return result
 
+    def _probe(self, ip):
+        if ip not in self.probe_results:
+            with profiler.timed("network probes", site=self.site, detail=ip):
+                self.probe_results.update(
+                    self.prober.probe([ip], ssh=self.check_ssh, cups=self.check_cups)
+                )
+        return self.probe_results[ip]
+
+    def probe_vms(self, vms):
+        """Probes the public IPs of all the VMs in a single batch"""
+        if not (self.check_ssh or self.check_cups):
+            return
+        public_ips = []
+        for vm in vms:
+            vm_ips = []
+            for net, addrs in vm["Networks"].items():
+                vm_ips.extend(addrs)
+            public_ip = self.get_public_ip(vm_ips)
+            if public_ip:
+                public_ips.append(public_ip)
+        with profiler.timed(
+            "network probes", site=self.site, detail=f"{len(public_ips)} IP(s)"
+        ):
+            self.probe_results.update(
+                self.prober.probe(public_ips, ssh=self.check_ssh, cups=self.check_cups)
+            )
+
     def get_sshd_version(self, ip_addresses):
         public_ip = self.get_public_ip(ip_addresses)
         if len(public_ip) > 0:
-            try:
-                ssh = paramiko.Transport((public_ip, 22))
-                ssh.start_client()
-                result = ssh.remote_version
-                ssh.close()
-                return result
-            except SSHException:
-                return "SSHException: could not retrieve SSH version"
+            return self._probe(public_ip).get("ssh", "")
         else:
             return "No public IP available to check SSH version."
 
-    def _run_shell_command(self, command):
-        completed = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        return completed.returncode, completed.stdout, completed.stderr
-
-    def check_open_port(self, ip, port, protocol):
-        if protocol == "tcp":
-            command = f"ncat --nodns -z {ip} {port}"
-        elif protocol == "udp":
-            command = f"ncat --udp --nodns --idle-timeout 3s {ip} {port}"
-        else:
-            raise SiteMonitorException(f"Protocol {protocol} not supported!")
-        returncode, stdout, stderr = self._run_shell_command(command)
-        return returncode, stdout, stderr
-
     def check_CUPS(self, ip_addresses):
-        returncode_ncat, stdout_ncat, stderr_ncat = self._run_shell_command(
-            "which ncat"
-        )
-        if returncode_ncat != 0:
-            return "ncat ( https://nmap.org/ncat ) is not installed"
         public_ip = self.get_public_ip(ip_addresses)
         if len(public_ip) > 0:
-            returncode_tcp, stdout_tcp, stderr_tcp = self.check_open_port(
-                public_ip, 631, "tcp"
-            )
-            returncode_upd, stdout_upd, stderr_upd = self.check_open_port(
-                public_ip, 631, "udp"
-            )
-            if returncode_tcp == 0 or returncode_upd == 0:
-                return "WARNING: CUPS port is open"
-            elif returncode_tcp == 1 and returncode_upd == 1:
-                return "CUPS port is closed"
-            else:
-                return (
-                    "Error checking CUPS port. "
-                    "TCP return code: {returncode_tcp}, stdout: {stdout_tcp}, stderr: {stderr_tcp}. "
-                    "UDP return code: {returncode_upd}, stdout: {stdout_upd}, stderr: {stderr_upd}."
-                )
+            return self._probe(public_ip).get("cups", "")
         else:
             return "No public IP available to check CUPs version"
 
+    def load_snapshot(self, vms):
+        """Shows the changes since the last run and finds the VMs to reuse
+
+        Returns the snapshot entries of the VMs that were not updated since
+        the last run, so they do not need to be processed again.
+        """
+        taken_at, snapshot = self.state.load(self.site, self.vo)
+        if taken_at is None:
+            return {}
+        ids = set(vm["ID"] for vm in vms)
+        appeared = sorted(ids - set(snapshot))
+        disappeared = sorted(set(snapshot) - ids)
+        if not self.emit("vm_changes", appeared=appeared, disappeared=disappeared):
+            if appeared:
+                self.echo(f"[+] New VM instance(s) since the last run: {appeared}")
+            if disappeared:
+                self.secho(
+                    f"[-] VM instance(s) gone since the last run: {disappeared}",
+                    fg="yellow",
+                )
+        changed = self.changed_vms(vms, snapshot, taken_at)
+        return {
+            vm_id: snapshot[vm_id]
+            for vm_id in ids & set(snapshot)
+            if vm_id not in changed and self._reusable(snapshot[vm_id]["record"])
+        }
+
+    def changed_vms(self, vms, snapshot, taken_at):
+        """IDs of the VMs updated since the snapshot was taken"""
+        if all("Updated" in vm for vm in vms):
+            # the api backend already has the updated time in the server list
+            return set(
+                vm["ID"]
+                for vm in vms
+                if vm["Updated"] != snapshot.get(vm["ID"], {}).get("updated")
+            )
+        command = ("server", "list", "--changes-since", taken_at)
+        return set(vm["ID"] for vm in self._run_command(command))
+
+    def _reusable(self, record):
+        # the record must have the same checks as the ones requested now, and
+        # the tags, which records of older snapshots do not have
+        return (
+            ("ssh_version" in record) == bool(self.check_ssh)
+            and ("cups" in record) == bool(self.check_cups)
+            and "tags" in record
+        )
+
+    def save_snapshot(self):
+        if self.state is not None:
+            vm_states = {
+                vm_id: {
+                    "updated": state["updated"],
+                    "record": state["record"].to_dict(),
+                }
+                for vm_id, state in self.vm_states.items()
+            }
+            self.state.save(self.site, self.vo, self.now.isoformat(), vm_states)
+
+    def save_history(self, records, quota_info, floating_ips, volumes):
+        """Adds the results of the run to the history, if kept"""
+        if self.history is not None:
+            summary = run_summary(self.max_days, records, floating_ips, volumes)
+            quotas = {
+                quota_resource_name(k): {"limit": v["Limit"], "in_use": v["In Use"]}
+                for k, v in quota_info.items()
+            }
+            self.history.add(self.site, self.vo, self.now.timestamp(), summary, quotas)
+
     def process_vm(self, vm):
+        previous = self.reused_vms.get(vm["ID"])
+        if previous is None:
+            record = self.vm_record(vm)
+            if self.state is not None:
+                updated = vm.get("Updated") or self.get_vm(vm).get("updated")
+        else:
+            # name and status come from the server list, the rest is unchanged
+            record = VMRecord.from_dict(previous["record"])
+            record.name = vm["Name"]
+            record.status = vm["Status"]
+            record.elapsed = self.now - parse(record.created_at)
+            record.over_max_days = record.elapsed.days >= self.max_days
+            updated = previous["updated"]
+        # the record has all that is needed from the details from now on
+        self.vm_details.pop(vm["ID"], None)
+        # the records are only kept for the snapshot of the incremental runs
+        if self.state is not None:
+            self.vm_states[vm["ID"]] = {"updated": updated, "record": record}
+        return record
+
+    def vm_record(self, vm):
+        """Information of the VM, rendered later as text or JSON"""
         vm_info = self.get_vm(vm)
         flv = self.get_flavor(vm["Flavor"])
         vm_ips = []
         for net, addrs in vm["Networks"].items():
             vm_ips.extend(addrs)
-        sshd_version = self.get_sshd_version(vm_ips)
-        created = parse(vm_info["created_at"])
-        elapsed = self.now - created
-        secgroups = set([secgroup["name"] for secgroup in vm_info["security_groups"]])
-        output = [
-            ("instance name", vm["Name"]),
-            ("instance id", vm["ID"]),
-            ("status", click.style(vm["Status"], fg=self.color_maps[vm["Status"]])),
-            ("ip address", " ".join(vm_ips)),
-            ("sec. groups", secgroups),
-        ]
+        elapsed = self.now - parse(vm_info["created_at"])
+        record = VMRecord(
+            vm["ID"],
+            vm["Name"],
+            vm["Status"],
+            ips=vm_ips,
+            security_groups=set(
+                [secgroup["name"] for secgroup in vm_info["security_groups"]]
+            ),
+            image=self.get_vm_image(
+                vm["ID"],
+                vm["Image Name"],
+                vm["Image ID"],
+                vm_info["attached_volumes"],
+            ),
+            created_at=vm_info["created_at"],
+            elapsed=elapsed,
+            over_max_days=elapsed.days >= self.max_days,
+            user_id=vm_info["user_id"],
+        )
         if self.check_ssh:
-            sshd_version = self.get_sshd_version(vm_ips)
-            output.append(("SSH version", sshd_version))
+            record.ssh_version = self.get_sshd_version(vm_ips)
         if self.check_cups:
-            CUPS_check = self.check_CUPS(vm_ips)
-            output.append(("CUPS", CUPS_check))
+            record.cups = self.check_CUPS(vm_ips)
         if flv:
-            output.append(
-                (
-                    "flavor",
-                    f"{flv['Name']} with {flv['VCPUs']} vCPU cores, {int(flv['RAM']/1024)} "
-                    f"GB of RAM and {flv['Disk']} GB of local disk",
-                )
-            )
-        output.append(
-            (
-                "VM image",
-                self.get_vm_image(
-                    vm["ID"],
-                    vm["Image Name"],
-                    vm["Image ID"],
-                    vm_info["attached_volumes"],
-                ),
-            )
-        )
-        output.append(("created at", vm_info["created_at"]))
-        output.append(("elapsed time", elapsed))
-        user_id = vm_info["user_id"]
-        output.append(("user", user_id))
-        user = self.get_user(user_id)
+            record.flavor_name = flv["Name"]
+            record.vcpus = flv["VCPUs"]
+            record.ram_gb = int(flv["RAM"] / 1024)
+            record.disk_gb = flv["Disk"]
+        user = self.get_user(record.user_id)
         if user:
-            if "email" not in user:
-                self.users[user_id]["email"] = self.get_user_email(
-                    user.get("Name", None)
-                )
-            output.append(("egi user", user.get("Name", "")))
-            output.append(("email", user.get("email", "")))
+            # the email depends on the VO, users are shared by all of them
+            record.egi_user = user.get("Name", "")
+            record.email = self.get_user_email(user.get("Name", None))
+        # only there if the site supports the requested microversion
+        record.tags = vm_info.get("tags")
         orchestrator = vm_info["properties"].get("eu.egi.cloud.orchestrator", None)
+        record.orchestrator = orchestrator
         if orchestrator == "es.upv.grycap.im":
-            output.append(
-                ("IM id", vm_info["properties"].get("eu.egi.cloud.orchestrator.id", ""))
-            )
-        return {
-            "ID": vm["ID"],
-            "output": output,
-            "elapsed": elapsed,
-            "secgroups": secgroups,
-        }
+            record.im_id = vm_info["properties"].get("eu.egi.cloud.orchestrator.id", "")
+        return record
 
     def vm_monitor(self, delete=False):
+        """Checks all the VMs of the site, returns their VMRecords"""
         all_vms = self.get_vms()
+        self.emit("site", vm_count=len(all_vms))
+        if self.state is not None:
+            self.reused_vms = self.load_snapshot(all_vms)
         if not all_vms:
-            click.secho("- No VM instances found in the resource provider", fg="yellow")
-            return
-        click.echo(
+            self.secho("- No VM instances found in the resource provider", fg="yellow")
+            self.save_snapshot()
+            return []
+        self.echo(
             f"[+] Total VM instance(s) running in the resource provider = {len(all_vms)}"
         )
-        vms_info = []
-        with click.progressbar(all_vms, label="Getting VMs information") as vms:
-            for vm in vms:
-                vms_info.append(self.process_vm(vm))
-        for i, vm in enumerate(vms_info):
-            click.echo(f"[+] VM #{i:<2} {'-'*50}")
-            for line in vm["output"]:
-                click.echo(f"    {line[0]:<14} = {line[1]}")
-            if vm["elapsed"].days >= self.max_days:
-                click.secho(
+        new_vms = [vm for vm in all_vms if vm["ID"] not in self.reused_vms]
+        if self.reused_vms:
+            self.echo(
+                f"[+] VM instance(s) not changed since the last run = "
+                f"{len(all_vms) - len(new_vms)}"
+            )
+        self.probe_vms(new_vms)
+        records = []
+        with click.progressbar(
+            length=len(all_vms) + len(self.missing_details(new_vms)),
+            label="Getting VMs information",
+            file=self._text_file(),
+        ) as bar:
+            # the emails of the owners are needed before the first record
+            self.prefetch_user_emails(new_vms, bar)
+            if self.vm_workers > 1:
+                with ThreadPoolExecutor(max_workers=self.vm_workers) as executor:
+                    futures = [executor.submit(self.process_vm, vm) for vm in all_vms]
+                    for future in as_completed(futures):
+                        self.emit("vm", **render_json(future.result()))
+                        bar.update(1)
+                # keep the same order as the server list
+                records = [future.result() for future in futures]
+            else:
+                for vm in all_vms:
+                    record = self.process_vm(vm)
+                    self.emit("vm", **render_json(record))
+                    records.append(record)
+                    bar.update(1)
+        for vm in records:
+            # union of sets
+            self.used_security_groups = self.used_security_groups | set(
+                vm.security_groups
+            )
+        self.save_snapshot()
+        if self.writer is None:
+            self.show_vms(records, delete)
+        return records
+
+    def show_vms(self, records, delete=False):
+        for i, vm in enumerate(records):
+            self.echo(f"[+] VM #{i:<2} {'-'*50}")
+            for line in render_text(vm):
+                self.echo(f"    {line[0]:<14} = {line[1]}")
+            if vm.elapsed.days >= self.max_days:
+                self.secho(
                     "[-] WARNING The VM instance elapsed time exceed the max offset!",
                     fg="yellow",
                 )
                 if delete:
                     if click.confirm("Do you want to delete the instance?"):
-                        self.delete_vm(vm)
-            # union of sets
-            self.used_security_groups = self.used_security_groups | vm["secgroups"]
+                        self.delete_vm({"ID": vm.id})
 
-    def check_unused_security_groups(self):
-        _, project_id, _ = find_endpoint_and_project_id(self.site, self.vo)
+    def get_endpoint(self):
+        """Endpoint, project ID and protocol of the site, looked up only once"""
+        return openstack_api.resolver.resolve(self.site, self.vo)
+
+    def start_audits(self, show_quotas=True):
+        """Starts getting the information of the site audits in the background
+
+        The audits wait for their information when they are run, so the
+        calls to the site overlap with the VM scan and with each other.
+        """
+        fetches = {
+            "floating ips": self._fetch_unused_floating_ips,
+            "security groups": self._fetch_security_groups,
+            "volumes": self._fetch_unused_volumes,
+        }
+        if show_quotas:
+            fetches["quota"] = self._fetch_quota
+        executor = ThreadPoolExecutor(max_workers=len(fetches))
+        for name, fetch in fetches.items():
+            self._audits[name] = executor.submit(fetch)
+        # the fetches keep on running, the executor is not needed anymore
+        executor.shutdown(wait=False)
+
+    def _audit(self, name, fetch):
+        """Information of the audit, from the background fetch if started"""
+        future = self._audits.pop(name, None)
+        if future is None:
+            return fetch()
+        return future.result()
+
+    def _fetch_security_groups(self):
+        _, project_id, _ = self.get_endpoint()
         command = ("security", "group", "list", "--project", project_id)
-        result = self._run_command(command)
+        return self._run_command(command)
+
+    def check_unused_security_groups(self):
+        result = self._audit("security groups", self._fetch_security_groups)
         # until we get security group IDs attached to VMs
         # all_secgroups = set([secgroup["ID"] for secgroup in result])
         all_secgroups = set([secgroup["Name"] for secgroup in result])
         unused_secgroups = all_secgroups - self.used_security_groups
+        if self.emit("unused_security_groups", names=sorted(unused_secgroups)):
+            return unused_secgroups
         if len(unused_secgroups) > 0:
-            click.secho(
+            self.secho(
                 "[-] WARNING: List of unused security groups: {}".format(
                     unused_secgroups
                 ),
                 fg="yellow",
             )
+        return unused_secgroups
 
-    def check_unused_floating_ips(self):
+    def _fetch_unused_floating_ips(self):
         # get list of unused floating IPs in <vo, site>
         command = ("floating", "ip", "list", "--status", "DOWN")
-        result = self._run_command(command)
+        return self._run_command(command)
+
+    def check_unused_floating_ips(self):
+        result = self._audit("floating ips", self._fetch_unused_floating_ips)
         floating_ips_down = [fip["Floating IP Address"] for fip in result]
+        if self.emit("unused_floating_ips", addresses=floating_ips_down):
+            return floating_ips_down
         if len(floating_ips_down) > 0:
-            click.secho(
+            self.secho(
                 "[-] WARNING: List of unused floating IPs: {}".format(
                     floating_ips_down
                 ),
                 fg="yellow",
             )
+        return floating_ips_down
 
-    def check_unused_volumes(self):
+    def _fetch_unused_volumes(self):
         # get list of unused volumes in <vo, site>
         command = ("volume", "list", "--status", "available")
-        result = self._run_command(command)
+        return self._run_command(command)
+
+    def check_unused_volumes(self):
+        result = self._audit("volumes", self._fetch_unused_volumes)
         unused_capacity = 0
         unused_volumes = []
         for volume in result:
@@ -418,30 +899,46 @@ class SiteMonitor:
             unused_volumes.append(
                 volume["Name"] if len(volume["Name"]) > 0 else volume["ID"]
             )
+        if self.emit(
+            "unused_volumes",
+            volumes=[
+                {"id": vol["ID"], "name": vol["Name"], "size_gb": vol["Size"]}
+                for vol in result
+            ],
+            capacity_gb=unused_capacity,
+        ):
+            return result
         if unused_capacity > 0:
-            click.secho(
+            self.secho(
                 "[-] WARNING: List of unused volumes: {}".format(unused_volumes),
                 fg="yellow",
             )
-            click.secho(
+            self.secho(
                 "[-] WARNING: {} GB could be claimed back deleting unused volumes.".format(
                     unused_capacity
                 ),
                 fg="yellow",
             )
+        return result
 
     def vo_check(self):
-        endpoint, _, _ = find_endpoint_and_project_id(self.site, self.vo)
+        endpoint, _, _ = self.get_endpoint()
         return endpoint is not None
 
-    def get_quota(self):
+    def _fetch_quota(self):
         command = ("quota", "show", "--usage")
-        return self._run_command(command, do_raise=False)
+        return self._run_command(command)
 
-    def show_quotas(self):
+    def get_quota(self):
+        try:
+            return self._audit("quota", self._fetch_quota)
+        except SiteMonitorException as e:
+            self.echo(" ".join([click.style("WARNING:", fg="yellow"), str(e)]))
+            return {}
+
+    def get_quota_info(self):
+        """In use and limit of the main resources in the quota"""
         quota = self.get_quota()
-        if not quota:
-            return
         resources = [
             "cores",
             "instances",
@@ -463,37 +960,54 @@ class SiteMonitor:
                         "In Use": r["In Use"],
                         "Limit": r["Limit"],
                     }
-        for k, v in quota_info.items():
-            click.echo(
-                "    {:<14} = Limit: {:>3}, Used: {:>3} ({}%)".format(
-                    k, v["Limit"], v["In Use"], round(v["In Use"] / v["Limit"] * 100)
-                )
-            )
-        # checks on quota
+        return quota_info
+
+    def quota_warnings(self, quota_info):
+        warnings = []
         if (
-            quota_info.get("ram (GB)").get("Limit", 1)
-            / quota_info.get("cores").get("Limit", 1)
+            quota_info.get("ram (GB)", {}).get("Limit", 1)
+            / quota_info.get("cores", {}).get("Limit", 1)
             < self.min_ram_cpu_ratio
         ):
-            click.secho(
-                f"[-] WARNING: Less than {self.min_ram_cpu_ratio} GB RAM per available CPU",
-                fg="yellow",
+            warnings.append(
+                f"Less than {self.min_ram_cpu_ratio} GB RAM per available CPU"
             )
         if (
-            quota_info.get("secgroups").get("Limit", 1)
-            / quota_info.get("instances").get("Limit", 1)
+            quota_info.get("secgroups", {}).get("Limit", 1)
+            / quota_info.get("instances", {}).get("Limit", 1)
             < self.min_secgroup_instance_ratio
         ):
-            click.secho(
-                f"[-] WARNING: Less than {self.min_secgroup_instance_ratio} security groups per instance",
-                fg="yellow",
+            warnings.append(
+                f"Less than {self.min_secgroup_instance_ratio} security groups per instance"
             )
         if (
-            quota_info.get("floating-ips").get("Limit", 1)
-            / quota_info.get("instances").get("Limit", 1)
+            quota_info.get("floating-ips", {}).get("Limit", 1)
+            / quota_info.get("instances", {}).get("Limit", 1)
             < self.min_ip_instance_ratio
         ):
-            click.secho(
-                f"[-] WARNING: Less than {self.min_ip_instance_ratio} floating IPs per instance",
-                fg="yellow",
+            warnings.append(
+                f"Less than {self.min_ip_instance_ratio} floating IPs per instance"
+            )
+        return warnings
+
+    def show_quotas(self):
+        quota_info = self.get_quota_info()
+        if not quota_info:
+            return quota_info
+        warnings = self.quota_warnings(quota_info)
+        resources = {
+            quota_resource_name(k): {"limit": v["Limit"], "in_use": v["In Use"]}
+            for k, v in quota_info.items()
+        }
+        if self.emit("quota", resources=resources, warnings=warnings):
+            return quota_info
+        for k, v in quota_info.items():
+            self.echo(
+                "    {:<14} = Limit: {:>3}, Used: {:>3} ({}%)".format(
+                    k, v["Limit"], v["In Use"], round(v["In Use"] / v["Limit"] * 100)
+                )
             )
+        # checks on quota
+        for warning in warnings:
+            self.secho(f"[-] WARNING: {warning}", fg="yellow")
+        return quota_info
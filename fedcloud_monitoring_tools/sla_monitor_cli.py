@@ -1,55 +1,121 @@
 """Monitor Accounting status"""
 
+import functools
 import importlib
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import yaml
 from fedcloud_monitoring_tools.accounting import Accounting
 from fedcloud_monitoring_tools.appdb import AppDB
+from fedcloud_monitoring_tools.cache import MetadataCache
 from fedcloud_monitoring_tools.goc import GOCDB
+from fedcloud_monitoring_tools.output import JSONLinesWriter
+from fedcloud_monitoring_tools.profiling import profiler
 
 
 def check_site_slas(site, site_slas, goc, acct, appdb):
-    click.secho(f"[-] Checking site {site}", fg="blue", bold=True)
+    """Checks the SLAs of the site, returns the findings as a record
+
+    Each finding has a level (OK, ERR, W or I) and a message, findings of
+    each SLA of the site are kept apart from the checks of additional VOs.
+    """
+    result = {"site": site, "slas": [], "findings": []}
     sla_vos = set()
     appdb_vos = set(appdb.get_vo_for_site(site))
+    site_vos = acct.site_vos(site)
     if site not in site_slas:
-        click.echo(f"[I] {site} is not present in any SLA")
+        result["findings"].append(
+            {"level": "I", "message": f"{site} is not present in any SLA"}
+        )
     else:
         for sla_name, sla in site_slas[site].items():
-            click.echo(f"Information for SLA {sla_name}")
+            findings = []
             sla_vos = sla_vos.union(sla["vos"])
-            accounted_vos = sla["vos"].intersection(acct.site_vos(site))
+            accounted_vos = sla["vos"].intersection(site_vos)
             if accounted_vos:
-                click.echo(
-                    f"[OK] {site} has accounting info for SLA {sla_name} ({accounted_vos})"
+                findings.append(
+                    {
+                        "level": "OK",
+                        "message": f"{site} has accounting info for SLA {sla_name} "
+                        f"({accounted_vos})",
+                        "vos": sorted(accounted_vos),
+                    }
                 )
             else:
-                click.echo(f"[ERR] {site} has no accounting info for SLA {sla_name}")
+                findings.append(
+                    {
+                        "level": "ERR",
+                        "message": f"{site} has no accounting info for SLA {sla_name}",
+                    }
+                )
             info_vos = sla["vos"].intersection(appdb_vos)
             if info_vos:
-                click.echo(f"[OK] {site} has configured {info_vos} for SLA {sla_name}")
+                findings.append(
+                    {
+                        "level": "OK",
+                        "message": f"{site} has configured {info_vos} for SLA "
+                        f"{sla_name}",
+                        "vos": sorted(info_vos),
+                    }
+                )
             else:
-                click.echo(f"[ERR] {site} has no configured VO for SLA {sla_name}")
-            click.echo()
-    click.secho(f"[-] Checking aditional VOs at {site}", fg="yellow", bold=True)
+                findings.append(
+                    {
+                        "level": "ERR",
+                        "message": f"{site} has no configured VO for SLA {sla_name}",
+                    }
+                )
+            result["slas"].append({"sla": sla_name, "findings": findings})
     # Now check which VOs are being reported without a SLA
+    additional = []
     if not sla_vos:
         sla_vos = goc.sla_vos
-    non_sla_vos = acct.site_vos(site) - sla_vos.union(set(["ops"]))
+    non_sla_vos = site_vos - sla_vos.union(set(["ops"]))
     if non_sla_vos:
-        click.echo(
-            f"[W] {site} has accounting for VOs {non_sla_vos} but not covered by SLA"
+        additional.append(
+            {
+                "level": "W",
+                "message": f"{site} has accounting for VOs {non_sla_vos} but not "
+                "covered by SLA",
+                "vos": sorted(non_sla_vos),
+            }
+        )
+    if "ops" not in site_vos:
+        additional.append(
+            {"level": "W", "message": f"{site} has no accounting for ops"}
         )
-    if "ops" not in acct.site_vos(site):
-        click.echo(f"[W] {site} has no accounting for ops")
     non_sla_appdb_vos = appdb_vos - sla_vos.union(set(["ops"]))
-    if non_sla_vos:
-        click.echo(
-            f"[W] {site} has VOs {non_sla_appdb_vos} configured but not covered by SLA"
+    if non_sla_appdb_vos:
+        additional.append(
+            {
+                "level": "W",
+                "message": f"{site} has VOs {non_sla_appdb_vos} configured but not "
+                "covered by SLA",
+                "vos": sorted(non_sla_appdb_vos),
+            }
         )
     if "ops" not in appdb_vos:
-        click.echo(f"[W] {site} has no configuration for ops")
+        additional.append(
+            {"level": "W", "message": f"{site} has no configuration for ops"}
+        )
+    result["additional_vos"] = additional
+    return result
+
+
+def show_site_slas(result):
+    site = result["site"]
+    click.secho(f"[-] Checking site {site}", fg="blue", bold=True)
+    for finding in result["findings"]:
+        click.echo(f"[{finding['level']}] {finding['message']}")
+    for sla in result["slas"]:
+        click.echo(f"Information for SLA {sla['sla']}")
+        for finding in sla["findings"]:
+            click.echo(f"[{finding['level']}] {finding['message']}")
+        click.echo()
+    click.secho(f"[-] Checking aditional VOs at {site}", fg="yellow", bold=True)
+    for finding in result["additional_vos"]:
+        click.echo(f"[{finding['level']}] {finding['message']}")
     click.echo()
 
 
@@ -57,10 +123,52 @@ def check_site_slas(site, site_slas, goc, acct, appdb):
 @click.option("--site", help="Site to check")
 @click.option("--user-cert", required=True, help="User certificate (for GOCDB queries)")
 @click.option("--vo-map-file", help="SLA-VO mapping file")
+@click.option(
+    "--refresh",
+    default=False,
+    is_flag=True,
+    help="Ignore cached metadata, fetch it again and update the cache",
+)
+@click.option(
+    "--no-cache",
+    default=False,
+    is_flag=True,
+    help="Do not use the metadata cache",
+)
+@click.option(
+    "--accounting-days",
+    default=90,
+    type=click.IntRange(min=1),
+    help="Number of days of accounting data to check",
+)
+@click.option(
+    "--parallel-sites",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of sites to check concurrently",
+)
+@click.option(
+    "--format",
+    "output_format",
+    default="text",
+    type=click.Choice(["text", "jsonl"]),
+    help="Output format, jsonl writes one JSON record per site",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["table", "json"]),
+    help="Time the calls to the services and show a report at the end",
+)
 def main(
     site,
     user_cert,
     vo_map_file,
+    refresh,
+    no_cache,
+    accounting_days,
+    parallel_sites,
+    output_format,
+    profile,
 ):
     if vo_map_file:
         with open(vo_map_file) as f:
@@ -70,13 +178,36 @@ def main(
             "fedcloud_monitoring_tools.data", "vos.yaml"
         )
     vo_map = yaml.load(vo_map_src, Loader=yaml.SafeLoader)
-    acct = Accounting()
-    goc = GOCDB()
-    appdb = AppDB()
-    slas = goc.get_sites_slas(user_cert, vo_map)
-
-    if site:
-        check_site_slas(site, slas, goc, acct, appdb)
+    profiler.enabled = profile is not None
+    cache = MetadataCache(refresh=refresh, enabled=not no_cache)
+    acct = Accounting(cache=cache, days=accounting_days)
+    goc = GOCDB(cache=cache)
+    appdb = AppDB(cache=cache)
+    with ThreadPoolExecutor(max_workers=max(parallel_sites, 3)) as executor:
+        # the data of every service is independent, get it at the same time
+        slas = executor.submit(goc.get_sites_slas, user_cert, vo_map)
+        all_sites = executor.submit(acct.all_sites)
+        executor.submit(appdb.load_index).result()
+        slas = slas.result()
+        sites = [site] if site else all_sites.result()
+    check = functools.partial(
+        check_site_slas, site_slas=slas, goc=goc, acct=acct, appdb=appdb
+    )
+    if parallel_sites > 1:
+        with ThreadPoolExecutor(max_workers=parallel_sites) as executor:
+            # results are shown in the same order as the sites
+            results = executor.map(check, sites)
     else:
-        for site in acct.all_sites():
-            check_site_slas(site, slas, goc, acct, appdb)
+        results = map(check, sites)
+    writer = JSONLinesWriter() if output_format == "jsonl" else None
+    for result in results:
+        if writer:
+            writer.write(dict(type="site_slas", **result))
+        else:
+            show_site_slas(result)
+    # records go to stdout, so any other text goes to stderr
+    text_err = writer is not None
+    if cache.enabled:
+        click.echo(f"[.] Metadata cache: {cache.report()}", err=text_err)
+    if profile:
+        click.echo(profiler.report(profile), err=text_err)
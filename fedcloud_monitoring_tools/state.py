@@ -0,0 +1,54 @@
+"""Snapshots of the VMs processed in the previous run of each site and VO"""
+
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from fedcloud_monitoring_tools.cache import default_cache_file
+
+
+def default_state_file():
+    return default_cache_file().with_name("state.sqlite")
+
+
+class VMStateStore:
+    """On-disk snapshot of the VM records of the last run of each site and VO
+
+    Each snapshot has the time of the run and, for every VM ID, its updated
+    timestamp and the record produced when it was processed.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        path = Path(path or default_state_file())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "site TEXT, vo TEXT, taken_at TEXT, vms TEXT, "
+            "PRIMARY KEY (site, vo))"
+        )
+        self._db.commit()
+
+    def load(self, site, vo):
+        """Time and VMs of the last snapshot of the site and VO
+
+        Returns (None, {}) if there is no snapshot.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT taken_at, vms FROM snapshots WHERE site = ? AND vo = ?",
+                (site, vo),
+            ).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def save(self, site, vo, taken_at, vms):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                (site, vo, taken_at, json.dumps(vms)),
+            )
+            self._db.commit()
@@ -1,21 +1,139 @@
 """Monitor VM instances running in the provider"""
 
+import functools
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import click
+from fedcloud_monitoring_tools import openstack_api
 from fedcloud_monitoring_tools.appdb import AppDB
-from fedcloud_monitoring_tools.site_monitor import SiteMonitor, SiteMonitorException
-from fedcloudclient.decorators import oidc_params
+from fedcloud_monitoring_tools.cache import MetadataCache
+from fedcloud_monitoring_tools.deletion import BulkDeleter, DeletionPolicy
+from fedcloud_monitoring_tools.history import HistoryStore
+from fedcloud_monitoring_tools.metrics import MetricsRegistry, start_metrics_server
+from fedcloud_monitoring_tools.output import JSONLinesWriter
+from fedcloud_monitoring_tools.probe import NetworkProber
+from fedcloud_monitoring_tools.profiling import profiler
+from fedcloud_monitoring_tools.serve import scan_site, serve_sites
+from fedcloud_monitoring_tools.site_monitor import (
+    SiteMonitor,
+    SiteMonitorException,
+    UserDirectory,
+)
+from fedcloud_monitoring_tools.state import VMStateStore
+from fedcloudclient.checkin import get_access_token
+from fedcloudclient.decorators import DEFAULT_MYTOKEN_SERVER
 from fedcloudclient.sites import list_sites
 
 
+def monitor_site(site_monitor, delete, show_quotas, deleter=None):
+    """Runs all the checks of a site
+
+    VMs are deleted without asking if there is a deleter. Returns the site
+    monitor and the error message (if any) of the checks.
+    """
+    site_monitor.secho(
+        f"[.] Checking VO {site_monitor.vo} at {site_monitor.site}",
+        fg="blue",
+        bold=True,
+    )
+    if not delete and (deleter is None or deleter.dry_run):
+        # deleting VMs may release floating IPs, volumes and security groups
+        site_monitor.start_audits(show_quotas)
+    try:
+        records = site_monitor.vm_monitor(delete)
+        if deleter is not None:
+            deleter.run(site_monitor, records)
+        quota_info = {}
+        if show_quotas:
+            site_monitor.echo("[+] Quota information:")
+            quota_info = site_monitor.show_quotas()
+        floating_ips = site_monitor.check_unused_floating_ips()
+        site_monitor.check_unused_security_groups()
+        volumes = site_monitor.check_unused_volumes()
+        site_monitor.save_history(records, quota_info, floating_ips, volumes)
+    except SiteMonitorException as e:
+        site_monitor.emit("error", message=str(e))
+        return site_monitor, str(e)
+    return site_monitor, None
+
+
+def monitor_site_vos(site_monitors, delete, show_quotas, deleter=None):
+    """Runs all the checks of a site for each of its VOs, one after the other
+
+    Returns the error messages of the checks, None for the VOs without error.
+    """
+    return [monitor_site(m, delete, show_quotas, deleter)[1] for m in site_monitors]
+
+
+def read_vo_file(vo_file):
+    """VO names in the file, one per line, # starts a comment"""
+    with open(vo_file) as f:
+        lines = [line.split("#", 1)[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
+def get_site_vos(vos, appdb, site=None):
+    """Sites to check and the VOs to check at each of them"""
+    site_vos = {}
+    for vo in vos:
+        if site:
+            vo_sites = [site]
+        else:
+            vo_sites = set(appdb.get_sites_for_vo(vo) + list_sites(vo))
+        for s in sorted(vo_sites):
+            site_vos.setdefault(s, []).append(vo)
+    return site_vos
+
+
+def show_site_error(error):
+    if error:
+        click.echo(" ".join([click.style("ERROR:", fg="red"), error]), err=True)
+
+
 @click.command()
-@oidc_params
+# same as fedcloudclient oidc_params, the daemon needs them to refresh the token
+@click.option(
+    "--oidc-agent-account",
+    help="Account name in oidc-agent",
+    envvar="OIDC_AGENT_ACCOUNT",
+    metavar="account",
+)
+@click.option(
+    "--oidc-access-token",
+    help="OIDC access token",
+    envvar="OIDC_ACCESS_TOKEN",
+    metavar="token",
+)
+@click.option(
+    "--mytoken",
+    help="Mytoken string",
+    envvar="FEDCLOUD_MYTOKEN",
+    metavar="mytoken",
+)
+@click.option(
+    "--mytoken-server",
+    help="Mytoken server",
+    envvar="FEDCLOUD_MYTOKEN_SERVER",
+    default=DEFAULT_MYTOKEN_SERVER,
+    show_default=True,
+    metavar="mytoken-server",
+)
 @click.option("--site", help="Restrict the monitoring to the site provided")
 @click.option(
     "--vo",
-    default="vo.access.egi.eu",
-    help="VO name to monitor",
+    "vos",
+    default=["vo.access.egi.eu"],
+    multiple=True,
+    help="VO name to monitor, can be given several times",
     show_default=True,
 )
+@click.option(
+    "--vo-file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="File with the VO names to monitor, one per line, instead of --vo",
+)
 @click.option(
     "--max-days",
     default=90,
@@ -29,6 +147,54 @@ from fedcloudclient.sites import list_sites
     help="Ask for deletion of VMs",
     show_default=True,
 )
+@click.option(
+    "--auto-delete",
+    default=False,
+    is_flag=True,
+    help="Delete without asking the VMs allowed by the deletion policy",
+    show_default=True,
+)
+@click.option(
+    "--dry-run",
+    default=False,
+    is_flag=True,
+    help="Only show the VMs that --auto-delete would delete",
+    show_default=True,
+)
+@click.option(
+    "--delete-vo",
+    multiple=True,
+    help="Only auto delete VMs of this VO, can be given several times",
+)
+@click.option(
+    "--delete-status",
+    multiple=True,
+    help="Only auto delete VMs with this status, can be given several times",
+)
+@click.option(
+    "--keep-tag",
+    multiple=True,
+    help="Never auto delete VMs with this tag, can be given several times",
+)
+@click.option(
+    "--keep-orchestrator",
+    multiple=True,
+    help="Never auto delete VMs created by this orchestrator, e.g. es.upv.grycap.im",
+)
+@click.option(
+    "--delete-rate",
+    default=2.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of VMs auto deleted per second at each site",
+    show_default=True,
+)
+@click.option(
+    "--delete-timeout",
+    default=600,
+    type=click.IntRange(min=0),
+    help="Seconds to wait for the auto deleted VMs to be gone",
+    show_default=True,
+)
 @click.option(
     "--show-quotas",
     default=True,
@@ -47,6 +213,123 @@ from fedcloudclient.sites import list_sites
     help="Check whether TCP/UDP port 631 is accessible",
     show_default=True,
 )
+@click.option(
+    "--format",
+    "output_format",
+    default="text",
+    type=click.Choice(["text", "jsonl"]),
+    help="Output format, jsonl writes one JSON record per line as soon as ready",
+    show_default=True,
+)
+@click.option(
+    "--probe-timeout",
+    default=5.0,
+    help="Timeout in seconds of the SSH and CUPS network probes",
+    show_default=True,
+)
+@click.option(
+    "--probe-concurrency",
+    default=100,
+    type=click.IntRange(min=1),
+    help="Maximum number of VMs probed at the same time",
+    show_default=True,
+)
+@click.option(
+    "--parallel-sites",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of sites to check concurrently",
+    show_default=True,
+)
+@click.option(
+    "--parallel-vms",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of VMs to process concurrently at each site",
+    show_default=True,
+)
+@click.option(
+    "--openstack-backend",
+    default="cli",
+    type=click.Choice(["cli", "api"]),
+    help="Run openstack commands with the CLI or call the APIs in-process",
+    show_default=True,
+)
+@click.option(
+    "--bulk-details",
+    default=False,
+    is_flag=True,
+    help="Get the details of all VMs with the server list (needs api backend)",
+    show_default=True,
+)
+@click.option(
+    "--refresh",
+    default=False,
+    is_flag=True,
+    help="Ignore cached metadata, fetch it again and update the cache",
+    show_default=True,
+)
+@click.option(
+    "--no-cache",
+    default=False,
+    is_flag=True,
+    help="Do not use the metadata cache",
+    show_default=True,
+)
+@click.option(
+    "--incremental",
+    default=False,
+    is_flag=True,
+    help="Only process the VMs that changed since the last incremental run",
+    show_default=True,
+)
+@click.option(
+    "--history",
+    "keep_history",
+    default=False,
+    is_flag=True,
+    help="Add the results of every site and VO to the history of runs",
+    show_default=True,
+)
+@click.option(
+    "--serve",
+    default=False,
+    is_flag=True,
+    help="Keep on checking the sites and serve the results as Prometheus metrics",
+    show_default=True,
+)
+@click.option(
+    "--interval",
+    default=3600,
+    type=click.IntRange(min=1),
+    help="Seconds between the checks of each site when serving",
+    show_default=True,
+)
+@click.option(
+    "--jitter",
+    default=300,
+    type=click.IntRange(min=0),
+    help="Maximum random seconds added to the interval of each site",
+    show_default=True,
+)
+@click.option(
+    "--metrics-address",
+    default="127.0.0.1",
+    help="Address to listen for metrics requests when serving",
+    show_default=True,
+)
+@click.option(
+    "--metrics-port",
+    default=9810,
+    type=click.IntRange(min=1, max=65535),
+    help="Port to listen for metrics requests when serving",
+    show_default=True,
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["table", "json"]),
+    help="Time the calls to the sites and services and show a report at the end",
+)
 @click.option(
     "--ldap-server",
     default="ldaps://ldap.aai.egi.eu:636",
@@ -63,24 +346,61 @@ from fedcloudclient.sites import list_sites
 @click.option("--ldap-password", help="LDAP password")
 @click.option(
     "--ldap-search-filter",
-    default="(isMemberOf=CO:COU:vo.access.egi.eu:members)",
+    default="(isMemberOf=CO:COU:{vo}:members)",
     show_default=True,
     help="LDAP search filter",
 )
+@click.option(
+    "--ldap-mode",
+    default="auto",
+    type=click.Choice(["auto", "full", "targeted"]),
+    show_default=True,
+    help="Get all the VO entries from LDAP or only those of the VM owners",
+)
 def main(
-    access_token,
+    oidc_agent_account,
+    oidc_access_token,
+    mytoken,
+    mytoken_server,
     site,
-    vo,
+    vos,
+    vo_file,
     max_days,
     delete,
+    auto_delete,
+    dry_run,
+    delete_vo,
+    delete_status,
+    keep_tag,
+    keep_orchestrator,
+    delete_rate,
+    delete_timeout,
     show_quotas,
     check_ssh,
     check_cups,
+    output_format,
+    probe_timeout,
+    probe_concurrency,
+    parallel_sites,
+    parallel_vms,
+    openstack_backend,
+    bulk_details,
+    refresh,
+    no_cache,
+    incremental,
+    keep_history,
+    serve,
+    interval,
+    jitter,
+    metrics_address,
+    metrics_port,
+    profile,
     ldap_server,
     ldap_base_dn,
     ldap_user,
     ldap_password,
     ldap_search_filter,
+    ldap_mode,
 ):
     ldap_config = {}
     if ldap_user and ldap_password:
@@ -91,24 +411,138 @@ def main(
                 "password": ldap_password,
                 "base_dn": ldap_base_dn,
                 "search_filter": ldap_search_filter,
+                "mode": ldap_mode,
             }
         )
-    appdb = AppDB()
-    appdb_sites = appdb.get_sites_for_vo(vo)
-    fedcloudclient_sites = list_sites(vo)
-    sites = [site] if site else set(appdb_sites + fedcloudclient_sites)
-    for s in sites:
-        click.secho(f"[.] Checking VO {vo} at {s}", fg="blue", bold=True)
-        site_monitor = SiteMonitor(
-            s, vo, access_token, max_days, check_ssh, check_cups, ldap_config
+    if delete and (auto_delete or dry_run):
+        raise click.UsageError("--delete can not be used with --auto-delete")
+    if (auto_delete or dry_run) and serve:
+        raise click.UsageError("--auto-delete can not be used with --serve")
+    if delete and serve:
+        raise click.UsageError("--delete can not be used with --serve")
+    if profile and serve:
+        # the calls would be kept forever and the report never shown
+        raise click.UsageError("--profile can not be used with --serve")
+    if delete and parallel_sites > 1:
+        raise click.UsageError("--delete can not be used with --parallel-sites")
+    if delete and output_format == "jsonl":
+        raise click.UsageError("--delete can not be used with --format jsonl")
+    if bulk_details and openstack_backend != "api":
+        raise click.UsageError("--bulk-details needs --openstack-backend api")
+    deleter = None
+    if auto_delete or dry_run:
+        policy = DeletionPolicy(
+            max_days,
+            vos=delete_vo,
+            statuses=delete_status,
+            keep_tags=keep_tag,
+            keep_orchestrators=keep_orchestrator,
+        )
+        deleter = BulkDeleter(
+            policy, dry_run=dry_run, rate=delete_rate, timeout=delete_timeout
+        )
+    get_token = functools.partial(
+        get_access_token, oidc_access_token, oidc_agent_account, mytoken, mytoken_server
+    )
+    access_token = get_token()
+    profiler.enabled = profile is not None
+    cache = MetadataCache(refresh=refresh, enabled=not no_cache)
+    prober = NetworkProber(timeout=probe_timeout, concurrency=probe_concurrency)
+    if vo_file:
+        vos = read_vo_file(vo_file)
+    # each site is checked once for all the VOs it supports
+    site_vos = get_site_vos(list(dict.fromkeys(vos)), AppDB(cache=cache), site)
+    # records go to stdout, so any other text goes to stderr
+    text_err = output_format == "jsonl"
+    new_site_monitor = functools.partial(
+        SiteMonitor,
+        token=access_token,
+        max_days=max_days,
+        check_ssh=check_ssh,
+        check_cups=check_cups,
+        ldap_config=ldap_config,
+        vm_workers=parallel_vms,
+        backend=openstack_backend,
+        bulk_details=bulk_details,
+        cache=cache,
+        prober=prober,
+        writer=JSONLinesWriter() if output_format == "jsonl" else None,
+        state=VMStateStore() if incremental else None,
+        directory=UserDirectory(),
+        history=HistoryStore() if keep_history else None,
+    )
+    if serve:
+        if not (oidc_agent_account or mytoken):
+            click.secho(
+                "[-] WARNING: the access token can not be refreshed, checks will "
+                "fail once it expires. Use --oidc-agent-account or --mytoken",
+                fg="yellow",
+                err=True,
+            )
+        elif oidc_access_token:
+            # it would be used instead of a new one for as long as it is valid
+            click.secho(
+                "[-] WARNING: ignoring --oidc-access-token (or OIDC_ACCESS_TOKEN), "
+                "a new access token is obtained from oidc-agent or mytoken",
+                fg="yellow",
+                err=True,
+            )
+            get_token = functools.partial(
+                get_access_token, None, oidc_agent_account, mytoken, mytoken_server
+            )
+        registry = MetricsRegistry()
+        start_metrics_server(registry, metrics_address, metrics_port)
+        click.echo(
+            f"[.] Serving metrics at http://{metrics_address}:{metrics_port}/metrics"
+        )
+        serve_sites(
+            [
+                new_site_monitor(s, vo, output=io.StringIO())
+                for s, s_vos in site_vos.items()
+                for vo in s_vos
+            ],
+            functools.partial(
+                scan_site,
+                show_quotas=show_quotas,
+                registry=registry,
+                get_token=get_token,
+            ),
+            interval,
+            jitter=jitter,
+            workers=parallel_sites,
         )
-        try:
-            site_monitor.vm_monitor(delete)
-            if show_quotas:
-                click.echo("[+] Quota information:")
-                site_monitor.show_quotas()
-            site_monitor.check_unused_floating_ips()
-            site_monitor.check_unused_security_groups()
-            site_monitor.check_unused_volumes()
-        except SiteMonitorException as e:
-            click.echo(" ".join([click.style("ERROR:", fg="red"), str(e)]), err=True)
+    start = time.monotonic()
+    if parallel_sites > 1:
+        with ThreadPoolExecutor(max_workers=parallel_sites) as executor:
+            futures = {}
+            for s, s_vos in site_vos.items():
+                output = io.StringIO()
+                site_monitors = [new_site_monitor(s, vo, output=output) for vo in s_vos]
+                future = executor.submit(
+                    monitor_site_vos, site_monitors, delete, show_quotas, deleter
+                )
+                futures[future] = output
+            # sites are shown as soon as they are done, each one in a block
+            for future in as_completed(futures):
+                click.echo(futures[future].getvalue(), nl=False, err=text_err)
+                for error in future.result():
+                    show_site_error(error)
+    else:
+        for s, s_vos in site_vos.items():
+            for vo in s_vos:
+                _, error = monitor_site(
+                    new_site_monitor(s, vo), delete, show_quotas, deleter
+                )
+                show_site_error(error)
+    elapsed = time.monotonic() - start
+    click.secho(
+        f"[.] Checked {len(site_vos)} site(s) in {elapsed:.1f} seconds",
+        fg="blue",
+        bold=True,
+        err=text_err,
+    )
+    if cache.enabled:
+        click.echo(f"[.] Metadata cache: {cache.report()}", err=text_err)
+    click.echo(f"[.] Site endpoints: {openstack_api.resolver.report()}", err=text_err)
+    if profile:
+        click.echo(profiler.report(profile), err=text_err)
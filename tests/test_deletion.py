@@ -0,0 +1,157 @@
+import unittest
+from datetime import timedelta
+
+from fedcloud_monitoring_tools.deletion import BulkDeleter, DeletionPolicy
+from fedcloud_monitoring_tools.records import VMRecord
+from fedcloud_monitoring_tools.site_monitor import SiteMonitorException
+
+
+def vm_record(
+    vm_id, days=100, status="ACTIVE", max_days=90, tags=(), orchestrator=None
+):
+    return VMRecord(
+        vm_id,
+        f"name-{vm_id}",
+        status,
+        elapsed=timedelta(days=days),
+        over_max_days=days >= max_days,
+        tags=tags,
+        orchestrator=orchestrator,
+    )
+
+
+class FakeSiteMonitor:
+    """Site monitor with the VMs in memory, only what BulkDeleter uses"""
+
+    def __init__(self, vms, vo="vo.example.org", fail=(), stuck=()):
+        self.vo = vo
+        self.fail = set(fail)
+        self.stuck = set(stuck)
+        self.vms = set(vms)
+        self.deleted = []
+        self.records = []
+        self.text = []
+
+    def delete_vm(self, vm, do_raise=False):
+        if vm["ID"] in self.fail:
+            raise SiteMonitorException("delete failed")
+        self.deleted.append(vm["ID"])
+        if vm["ID"] not in self.stuck:
+            self.vms.discard(vm["ID"])
+
+    def list_vms(self):
+        return [{"ID": vm_id} for vm_id in sorted(self.vms)]
+
+    def emit(self, record_type, **fields):
+        self.records.append(dict(type=record_type, **fields))
+        return True
+
+    def echo(self, message=None, **kwargs):
+        self.text.append(message)
+
+    def secho(self, message=None, **styles):
+        self.text.append(message)
+
+
+class TestDeletionPolicy(unittest.TestCase):
+    def test_delete_old_vm(self):
+        policy = DeletionPolicy(90)
+        self.assertIsNone(policy.keep_reason("vo", vm_record("a")))
+
+    def test_keep_young_vm(self):
+        policy = DeletionPolicy(90)
+        reason = policy.keep_reason("vo", vm_record("a", days=89))
+        self.assertIn("less than 90 days", reason)
+
+    def test_keep_other_vo(self):
+        policy = DeletionPolicy(90, vos=["vo"])
+        self.assertIsNone(policy.keep_reason("vo", vm_record("a")))
+        reason = policy.keep_reason("other", vm_record("a"))
+        self.assertIn("VO other", reason)
+
+    def test_keep_other_status(self):
+        policy = DeletionPolicy(90, statuses=["shutoff"])
+        record = vm_record("a", status="SHUTOFF")
+        self.assertIsNone(policy.keep_reason("vo", record))
+        reason = policy.keep_reason("vo", vm_record("a"))
+        self.assertIn("status ACTIVE", reason)
+
+    def test_keep_tag(self):
+        policy = DeletionPolicy(90, keep_tags=["keep"])
+        record = vm_record("a", tags=["other", "keep"])
+        self.assertEqual(policy.keep_reason("vo", record), "tagged keep")
+        record = vm_record("a", tags=["other"])
+        self.assertIsNone(policy.keep_reason("vo", record))
+
+    def test_keep_if_tags_missing(self):
+        policy = DeletionPolicy(90, keep_tags=["keep"])
+        reason = policy.keep_reason("vo", vm_record("a", tags=None))
+        self.assertIn("tags not available", reason)
+        # missing tags do not matter if no tag has to be kept
+        policy = DeletionPolicy(90)
+        self.assertIsNone(policy.keep_reason("vo", vm_record("a", tags=None)))
+
+    def test_keep_orchestrator(self):
+        policy = DeletionPolicy(90, keep_orchestrators=["es.upv.grycap.im"])
+        record = vm_record("a", orchestrator="es.upv.grycap.im")
+        reason = policy.keep_reason("vo", record)
+        self.assertEqual(reason, "created by es.upv.grycap.im")
+        self.assertIsNone(policy.keep_reason("vo", vm_record("a")))
+
+
+class TestBulkDeleter(unittest.TestCase):
+    def setUp(self):
+        self.records = [
+            vm_record("old"),
+            vm_record("young", days=10),
+            vm_record("failing"),
+            vm_record("stuck"),
+            vm_record("tagged", tags=["keep"]),
+        ]
+        self.vms = [record.id for record in self.records]
+        self.policy = DeletionPolicy(90, keep_tags=["keep"])
+
+    def result(self, site_monitor):
+        return [r for r in site_monitor.records if r["type"] == "deletion_result"]
+
+    def test_dry_run(self):
+        site_monitor = FakeSiteMonitor(self.vms)
+        deleter = BulkDeleter(self.policy, dry_run=True)
+        self.assertEqual(deleter.run(site_monitor, self.records), [])
+        self.assertEqual(site_monitor.deleted, [])
+        actions = {r["id"]: r["action"] for r in site_monitor.records}
+        self.assertEqual(
+            actions,
+            {
+                "old": "dry_run",
+                "failing": "dry_run",
+                "stuck": "dry_run",
+                "tagged": "keep",
+            },
+        )
+        self.assertEqual(self.result(site_monitor), [])
+
+    def test_delete(self):
+        site_monitor = FakeSiteMonitor(self.vms, fail=["failing"], stuck=["stuck"])
+        deleter = BulkDeleter(self.policy, rate=1000, timeout=0.05, poll_interval=0)
+        left = deleter.run(site_monitor, self.records)
+        self.assertEqual(left, ["failing", "stuck"])
+        self.assertEqual(sorted(site_monitor.deleted), ["old", "stuck"])
+        self.assertEqual(
+            self.result(site_monitor),
+            [
+                {
+                    "type": "deletion_result",
+                    "deleted": ["old"],
+                    "failed": {"failing": "delete failed"},
+                    "pending": ["stuck"],
+                }
+            ],
+        )
+        self.assertEqual(
+            sorted(site_monitor.vms), ["failing", "stuck", "tagged", "young"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
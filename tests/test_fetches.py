@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fedcloud_monitoring_tools.cache import MetadataCache
+from fedcloud_monitoring_tools.site_monitor import (
+    ImageResolver,
+    SingleFlight,
+    SiteMonitorException,
+)
+
+WORKERS = 8
+
+
+def run_concurrently(function, *args):
+    """Results of WORKERS calls of the function started at the same time"""
+    barrier = threading.Barrier(WORKERS)
+
+    def call(_):
+        barrier.wait()
+        return function(*args)
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        return list(executor.map(call, range(WORKERS)))
+
+
+class FakeSiteMonitor:
+    """Site monitor with images and volumes in memory, only what ImageResolver uses"""
+
+    def __init__(self, images, volumes):
+        self.cache = MetadataCache(enabled=False)
+        self.cache_key = ("SITE", "vo.example.org")
+        self.images = images
+        self.volumes = volumes
+        self.commands = Counter()
+        self._lock = threading.Lock()
+
+    def _run_command(self, command, do_raise=True, json_output=True, scoped=True):
+        with self._lock:
+            self.commands[" ".join(command[:3])] += 1
+        # give the other callers time to ask for the same
+        time.sleep(0.01)
+        if command[:2] == ("image", "list"):
+            return [{"ID": k, "properties": v} for k, v in self.images.items()]
+        if command[:2] == ("volume", "list"):
+            return [
+                {"ID": k, "volume_image_metadata": v} for k, v in self.volumes.items()
+            ]
+        if command[:2] == ("image", "show") and command[2] in self.images:
+            return {"properties": self.images[command[2]]}
+        if command[:2] == ("volume", "show") and command[2] in self.volumes:
+            return {"volume_image_metadata": self.volumes[command[2]]}
+        raise SiteMonitorException(f"{command[2]} not found")
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_callers(self):
+        fetches = SingleFlight()
+        calls = Counter()
+
+        def fetch():
+            calls["fetch"] += 1
+            time.sleep(0.01)
+            return object()
+
+        results = run_concurrently(fetches.run, "users", fetch)
+        self.assertEqual(calls["fetch"], 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_failed_fetch_not_repeated(self):
+        fetches = SingleFlight()
+        calls = Counter()
+
+        def fetch():
+            calls["fetch"] += 1
+            # errors are dealt with by the fetch itself
+            return None
+
+        run_concurrently(fetches.run, "users", fetch)
+        fetches.run("users", fetch)
+        self.assertEqual(calls["fetch"], 1)
+
+    def test_forget(self):
+        fetches = SingleFlight()
+        calls = Counter()
+
+        def fetch():
+            calls["fetch"] += 1
+            return calls["fetch"]
+
+        self.assertEqual(fetches.run("users", fetch), 1)
+        self.assertEqual(fetches.run("users", fetch), 1)
+        fetches.forget("users")
+        self.assertEqual(run_concurrently(fetches.run, "users", fetch), [2] * WORKERS)
+        # other names are not affected
+        self.assertEqual(fetches.run("flavors", fetch), 3)
+        fetches.forget("flavors")
+        self.assertEqual(fetches.run("users", fetch), 2)
+
+
+class TestImageResolver(unittest.TestCase):
+    images = {"img1": {"os_distro": "ubuntu", "os_version": "22.04"}}
+    volumes = {"vol1": {"image_name": "ubuntu"}}
+
+    def test_preload_once(self):
+        site_monitor = FakeSiteMonitor(self.images, self.volumes)
+        resolver = ImageResolver(site_monitor, preload=True)
+        results = run_concurrently(resolver.image_properties, "img1")
+        self.assertEqual(results, [self.images["img1"]] * WORKERS)
+        results = run_concurrently(resolver.volume_image_metadata, "vol1")
+        self.assertEqual(results, [self.volumes["vol1"]] * WORKERS)
+        self.assertEqual(
+            site_monitor.commands,
+            Counter({"image list --long": 1, "volume list --long": 1}),
+        )
+
+    def test_show_once(self):
+        site_monitor = FakeSiteMonitor(self.images, self.volumes)
+        resolver = ImageResolver(site_monitor)
+        results = run_concurrently(resolver.image_properties, "img1")
+        self.assertEqual(results, [self.images["img1"]] * WORKERS)
+        resolver.image_properties("img1")
+        self.assertEqual(site_monitor.commands, Counter({"image show img1": 1}))
+
+    def test_not_found_once(self):
+        site_monitor = FakeSiteMonitor(self.images, self.volumes)
+        resolver = ImageResolver(site_monitor, preload=True)
+        results = run_concurrently(resolver.image_properties, "gone")
+        self.assertEqual(results, [None] * WORKERS)
+        results = run_concurrently(resolver.volume_image_metadata, "gone")
+        self.assertEqual(results, [None] * WORKERS)
+        resolver.image_properties("gone")
+        resolver.volume_image_metadata("gone")
+        self.assertEqual(site_monitor.commands["image show gone"], 1)
+        self.assertEqual(site_monitor.commands["volume show gone"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import tempfile
+import unittest
+from datetime import timedelta
+from pathlib import Path
+
+from fedcloud_monitoring_tools.history import DAY, HistoryStore, run_summary
+from fedcloud_monitoring_tools.records import VMRecord
+
+
+def summary(vms):
+    records = [
+        VMRecord(str(i), f"name-{i}", "ACTIVE", elapsed=timedelta(days=1))
+        for i in range(vms)
+    ]
+    return run_summary(90, records, [], [])
+
+
+class TestVMTrends(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.history = HistoryStore(Path(tmp.name) / "history.sqlite")
+
+    def growth(self, site):
+        trends = {t["site"]: t for t in self.history.vm_trends(0)}
+        return trends[site]["vms_growth_30d"]
+
+    def test_growth(self):
+        self.history.add("A", "vo", 0, summary(2))
+        self.history.add("A", "vo", 10 * DAY, summary(7))
+        self.assertEqual(self.growth("A"), 15)
+
+    def test_no_growth_within_a_day(self):
+        self.history.add("A", "vo", 0, summary(2))
+        self.history.add("A", "vo", 3600, summary(5))
+        self.history.add("B", "vo", 0, summary(5))
+        self.assertIsNone(self.growth("A"))
+        self.assertIsNone(self.growth("B"))
+
+
+if __name__ == "__main__":
+    unittest.main()
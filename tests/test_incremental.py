@@ -0,0 +1,208 @@
+import io
+import tempfile
+import unittest
+from datetime import timedelta
+from pathlib import Path
+
+from fedcloud_monitoring_tools.records import VMRecord
+from fedcloud_monitoring_tools.site_monitor import SiteMonitor
+from fedcloud_monitoring_tools.state import VMStateStore
+
+
+class FakeProber:
+    def probe(self, ips, ssh=False, cups=False):
+        return {}
+
+
+class FakeWriter:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+class FakeSiteMonitor(SiteMonitor):
+    """Site monitor with the openstack commands answered from memory"""
+
+    def __init__(self, vms, changed=(), **kwargs):
+        super().__init__(
+            "SITE",
+            "vo.example.org",
+            "token",
+            90,
+            kwargs.pop("check_ssh", False),
+            kwargs.pop("check_cups", False),
+            prober=FakeProber(),
+            output=io.StringIO(),
+            **kwargs,
+        )
+        self.vms = vms
+        self.changed = list(changed)
+        self.commands = []
+
+    def _run_command(self, command, do_raise=True, json_output=True, scoped=True):
+        self.commands.append(command[:2])
+        if command[:2] == ("server", "list"):
+            if "--changes-since" in command:
+                return [{"ID": vm_id} for vm_id in self.changed]
+            return self.vms
+        if command[:2] == ("server", "show"):
+            return {
+                "id": command[2],
+                "created_at": "2024-01-01T00:00:00Z",
+                "updated": "2024-01-02T00:00:00Z",
+                "user_id": "user-1",
+                "security_groups": [{"name": "default"}],
+                "attached_volumes": [],
+                "properties": {},
+            }
+        if command[:2] == ("flavor", "list"):
+            return [{"Name": "m1", "VCPUs": 2, "RAM": 4096, "Disk": 20}]
+        if command[:2] == ("user", "list"):
+            return [{"ID": "user-1", "Name": "user1@egi.eu"}]
+        raise AssertionError(f"unexpected command {command}")
+
+    def shown(self):
+        return [c for c in self.commands if c == ("server", "show")]
+
+
+def vm(vm_id, status="ACTIVE", **fields):
+    """VM as in the server list"""
+    result = {
+        "ID": vm_id,
+        "Name": f"name-{vm_id}",
+        "Status": status,
+        "Networks": {"private": ["10.0.0.1"]},
+        "Image Name": "ubuntu",
+        "Image ID": "img1",
+        "Flavor": "m1",
+    }
+    result.update(fields)
+    return result
+
+
+class TestVMRecord(unittest.TestCase):
+    def test_round_trip(self):
+        record = VMRecord(
+            "vm1",
+            "name",
+            "ACTIVE",
+            ips=["10.0.0.1", "192.0.2.1"],
+            security_groups={"web", "default"},
+            ssh_version="OpenSSH_9.6",
+            cups="",
+            flavor_name="m1",
+            vcpus=2,
+            ram_gb=4,
+            disk_gb=20,
+            image="ubuntu",
+            created_at="2024-01-01T00:00:00Z",
+            elapsed=timedelta(days=100, seconds=30),
+            over_max_days=True,
+            user_id="user-1",
+            egi_user="user1@egi.eu",
+            email="user1@example.org",
+            im_id="im-1",
+            tags=["keep"],
+            orchestrator="es.upv.grycap.im",
+        )
+        copy = VMRecord.from_dict(record.to_dict())
+        for name in VMRecord.__slots__:
+            self.assertEqual(getattr(copy, name), getattr(record, name), name)
+
+    def test_round_trip_unknown_values(self):
+        record = VMRecord("vm1", "name", "SHUTOFF")
+        self.assertNotIn("ssh_version", record.to_dict())
+        self.assertNotIn("flavor", record.to_dict())
+        copy = VMRecord.from_dict(record.to_dict())
+        for name in VMRecord.__slots__:
+            self.assertEqual(getattr(copy, name), getattr(record, name), name)
+
+
+class TestIncrementalRuns(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.state = VMStateStore(Path(tmp.name) / "state.sqlite")
+
+    def run_monitor(self, vms, **kwargs):
+        site_monitor = FakeSiteMonitor(vms, state=self.state, **kwargs)
+        records = site_monitor.vm_monitor()
+        return site_monitor, records
+
+    def test_reuse_unchanged(self):
+        first, records = self.run_monitor([vm("vm1"), vm("vm2")])
+        self.assertEqual(len(first.shown()), 2)
+        second, reused = self.run_monitor([vm("vm1", status="SHUTOFF"), vm("vm2")])
+        self.assertEqual(second.shown(), [])
+        self.assertIn(("server", "list"), second.commands)
+        # name and status come from the server list
+        self.assertEqual(reused[0].status, "SHUTOFF")
+        reused[0].status = "ACTIVE"
+        for record, copy in zip(records, reused):
+            copy.elapsed = record.elapsed
+            self.assertEqual(copy.to_dict(), record.to_dict())
+
+    def test_details_dropped(self):
+        site_monitor, _ = self.run_monitor([vm("vm1"), vm("vm2")])
+        self.assertEqual(site_monitor.vm_details, {})
+
+    def test_reprocess_without_tags(self):
+        self.run_monitor([vm("vm1"), vm("vm2")])
+        # records of a snapshot taken before the tags were in the records
+        taken_at, vms = self.state.load("SITE", "vo.example.org")
+        del vms["vm2"]["record"]["tags"]
+        self.state.save("SITE", "vo.example.org", taken_at, vms)
+        second, _ = self.run_monitor([vm("vm1"), vm("vm2")])
+        self.assertEqual(len(second.shown()), 1)
+        self.assertEqual(second.reused_vms.keys(), {"vm1"})
+
+    def test_reprocess_changed_since(self):
+        self.run_monitor([vm("vm1"), vm("vm2")])
+        second, _ = self.run_monitor([vm("vm1"), vm("vm2")], changed=["vm2"])
+        self.assertEqual(len(second.shown()), 1)
+        self.assertEqual(second.reused_vms.keys(), {"vm1"})
+
+    def test_reprocess_updated(self):
+        updated = "2024-01-02T00:00:00Z"
+        self.run_monitor([vm("vm1", Updated=updated), vm("vm2", Updated=updated)])
+        second, _ = self.run_monitor(
+            [vm("vm1", Updated=updated), vm("vm2", Updated="2024-02-01T00:00:00Z")]
+        )
+        # the updated time of the server list is enough, no changes-since
+        self.assertEqual(second.commands.count(("server", "list")), 1)
+        self.assertEqual(second.reused_vms.keys(), {"vm1"})
+
+    def test_reprocess_other_checks(self):
+        self.run_monitor([vm("vm1")])
+        second, records = self.run_monitor([vm("vm1")], check_ssh=True)
+        self.assertEqual(len(second.shown()), 1)
+        self.assertIsNotNone(records[0].ssh_version)
+        third, _ = self.run_monitor([vm("vm1")], check_ssh=True)
+        self.assertEqual(third.shown(), [])
+        fourth, _ = self.run_monitor([vm("vm1")], check_cups=True)
+        self.assertEqual(len(fourth.shown()), 1)
+
+    def test_appeared_and_disappeared(self):
+        self.run_monitor([vm("vm1"), vm("vm2")])
+        writer = FakeWriter()
+        second, _ = self.run_monitor([vm("vm2"), vm("vm3")], writer=writer)
+        changes = [r for r in writer.records if r["type"] == "vm_changes"]
+        self.assertEqual(
+            changes,
+            [
+                {
+                    "type": "vm_changes",
+                    "site": "SITE",
+                    "vo": "vo.example.org",
+                    "appeared": ["vm3"],
+                    "disappeared": ["vm1"],
+                }
+            ],
+        )
+        self.assertEqual(second.reused_vms.keys(), {"vm2"})
+
+
+if __name__ == "__main__":
+    unittest.main()
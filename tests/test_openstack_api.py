@@ -0,0 +1,257 @@
+import unittest
+
+from fedcloud_monitoring_tools.openstack_api import IMAGE_STRING_FOR_BFV, SiteSession
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeAdapter:
+    """Adapter answering GET calls with the responses of each path"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def get(self, path, params=None, **kwargs):
+        self.calls.append((path, dict(params or {})))
+        response = self.responses[path]
+        if callable(response):
+            response = response(params or {})
+        return FakeResponse(response)
+
+
+def site_session(**adapters):
+    """Session of a site with fake adapters, no call leaves the test"""
+    session = SiteSession("token", "https://keystone.example.org:5000/v3", "oidc")
+    session.project_id = "project"
+    for service_type, responses in adapters.items():
+        session._adapters[service_type.replace("_", "-")] = FakeAdapter(responses)
+    return session
+
+
+def nova_pages(items, key, max_limit):
+    """Pages of the items as returned by Nova or Cinder with a max_limit"""
+
+    def page(params):
+        start = 0
+        if "marker" in params:
+            start = [item["id"] for item in items].index(params["marker"]) + 1
+        end = start + min(params["limit"], max_limit)
+        response = {key: items[start:end]}
+        if end < len(items):
+            response[f"{key}_links"] = [{"rel": "next", "href": "ignored"}]
+        return response
+
+    return page
+
+
+class TestPaging(unittest.TestCase):
+    volumes = [
+        {"id": f"vol{i}", "name": f"volume-{i}", "status": "available", "size": 1}
+        for i in range(5)
+    ]
+
+    def test_pages_shorter_than_page_size(self):
+        session = site_session(
+            block_storage={"/volumes/detail": nova_pages(self.volumes, "volumes", 2)}
+        )
+        volumes = session.volume_list(("volume", "list"))
+        self.assertEqual([vol["ID"] for vol in volumes], [f"vol{i}" for i in range(5)])
+        markers = [
+            params.get("marker") for _, params in session._api("block-storage").calls
+        ]
+        self.assertEqual(markers, [None, "vol1", "vol3"])
+
+    def test_glance_next(self):
+        images = [
+            {"id": f"img{i}", "name": f"image-{i}", "status": "active"}
+            for i in range(3)
+        ]
+
+        def page(params):
+            if "marker" in params:
+                return {"images": images[2:]}
+            return {"images": images[:2], "next": "/v2/images?marker=img1"}
+
+        session = site_session(image={"/v2/images": page})
+        result = session.image_list(("image", "list"))
+        self.assertEqual([image["ID"] for image in result], ["img0", "img1", "img2"])
+
+    def test_single_page(self):
+        session = site_session(
+            block_storage={"/volumes/detail": {"volumes": self.volumes}}
+        )
+        self.assertEqual(len(session.volume_list(("volume", "list"))), 5)
+        self.assertEqual(len(session._api("block-storage").calls), 1)
+
+
+def server(server_id, **fields):
+    """Server as returned by the compute API at microversion 2.26"""
+    result = {
+        "id": server_id,
+        "name": f"name-{server_id}",
+        "status": "ACTIVE",
+        "created": "2024-01-01T00:00:00Z",
+        "updated": "2024-01-02T00:00:00Z",
+        "user_id": "user",
+        "tenant_id": "project",
+        "addresses": {"private": [{"addr": "10.0.0.1"}, {"addr": "192.0.2.1"}]},
+        "image": {"id": "img1"},
+        "flavor": {"id": "f1"},
+        "security_groups": [{"name": "default"}],
+        "os-extended-volumes:volumes_attached": [{"id": "vol1"}],
+        "metadata": {"eu.egi.cloud.orchestrator": "es.upv.grycap.im"},
+        "tags": ["keep"],
+    }
+    result.update(fields)
+    return result
+
+
+class TestConversions(unittest.TestCase):
+    """Results have the shape of the JSON output of the openstack CLI"""
+
+    flavors = {
+        "flavors": [
+            {
+                "id": "f1",
+                "name": "m1.small",
+                "ram": 2048,
+                "disk": 20,
+                "vcpus": 1,
+                "OS-FLV-EXT-DATA:ephemeral": 0,
+                "os-flavor-access:is_public": True,
+                "extra_specs": {"hw:cpu_policy": "shared"},
+            }
+        ]
+    }
+    image = {
+        "id": "img1",
+        "name": "ubuntu-22.04",
+        "status": "active",
+        "size": 1024,
+        "os_distro": "ubuntu",
+        "os_version": "22.04",
+    }
+
+    def test_quota_show(self):
+        compute = {
+            "id": "project",
+            "cores": {"limit": 100, "in_use": 10, "reserved": 0},
+            "metadata_items": {"limit": 128, "in_use": 0, "reserved": 0},
+            "key_pairs": {"limit": 10, "in_use": 1, "reserved": 0},
+            # deprecated, not the values of the network API
+            "floating_ips": {"limit": -1, "in_use": 0, "reserved": 0},
+            "security_groups": {"limit": -1, "in_use": 0, "reserved": 0},
+        }
+        network = {
+            "floatingip": {"limit": 50, "used": 5, "reserved": 0},
+            "security_group": {"limit": 20, "used": 2, "reserved": 0},
+        }
+        session = site_session(
+            compute={"/os-quota-sets/project/detail": {"quota_set": compute}},
+            network={"/v2.0/quotas/project/details": {"quota": network}},
+        )
+        quotas = session.quota_show(("quota", "show"))
+        resources = [quota["Resource"] for quota in quotas]
+        self.assertEqual(
+            sorted(resources),
+            ["cores", "floating-ips", "key-pairs", "properties", "secgroups"],
+        )
+        quotas = {quota["Resource"]: quota for quota in quotas}
+        self.assertEqual(
+            quotas["floating-ips"],
+            {"Resource": "floating-ips", "Limit": 50, "In Use": 5, "Reserved": 0},
+        )
+        self.assertEqual(quotas["secgroups"]["Limit"], 20)
+        self.assertEqual(quotas["cores"]["In Use"], 10)
+
+    def test_image_show(self):
+        session = site_session(image={"/v2/images/img1": self.image})
+        image = session.image_show(("image", "show", "img1"))
+        self.assertEqual(
+            image,
+            {
+                "id": "img1",
+                "name": "ubuntu-22.04",
+                "status": "active",
+                "size": 1024,
+                "properties": {"os_distro": "ubuntu", "os_version": "22.04"},
+            },
+        )
+
+    def test_flavor_list(self):
+        session = site_session(compute={"/flavors/detail": self.flavors})
+        self.assertEqual(
+            session.flavor_list(("flavor", "list")),
+            [
+                {
+                    "ID": "f1",
+                    "Name": "m1.small",
+                    "RAM": 2048,
+                    "Disk": 20,
+                    "Ephemeral": 0,
+                    "VCPUs": 1,
+                    "Is Public": True,
+                    "Swap": "",
+                    "RXTX Factor": 1.0,
+                    "Properties": {"hw:cpu_policy": "shared"},
+                }
+            ],
+        )
+        # private flavors are also listed
+        self.assertEqual(session._api("compute").calls[0][1]["is_public"], "None")
+
+    def test_server_show(self):
+        session = site_session(compute={"/servers/vm1": {"server": server("vm1")}})
+        self.assertEqual(
+            session.server_show(("server", "show", "vm1")),
+            {
+                "id": "vm1",
+                "name": "name-vm1",
+                "status": "ACTIVE",
+                "created_at": "2024-01-01T00:00:00Z",
+                "updated": "2024-01-02T00:00:00Z",
+                "user_id": "user",
+                "project_id": "project",
+                "security_groups": [{"name": "default"}],
+                "attached_volumes": [{"id": "vol1"}],
+                "properties": {"eu.egi.cloud.orchestrator": "es.upv.grycap.im"},
+                "tags": ["keep"],
+            },
+        )
+
+    def test_server_show_without_tags(self):
+        vm = server("vm1")
+        del vm["tags"]
+        session = site_session(compute={"/servers/vm1": {"server": vm}})
+        self.assertNotIn("tags", session.server_show(("server", "show", "vm1")))
+
+    def test_server_list(self):
+        servers = [server("vm1"), server("vm2", image="")]
+        session = site_session(
+            compute={
+                "/servers/detail": {"servers": servers},
+                "/flavors/detail": self.flavors,
+            },
+            image={"/v2/images/img1": self.image},
+        )
+        vms = session.server_list(("server", "list", "--long"))
+        self.assertEqual([vm["ID"] for vm in vms], ["vm1", "vm2"])
+        self.assertEqual(vms[0]["Networks"], {"private": ["10.0.0.1", "192.0.2.1"]})
+        self.assertEqual(vms[0]["Image Name"], "ubuntu-22.04")
+        self.assertEqual(vms[0]["Image ID"], "img1")
+        self.assertEqual(vms[0]["Flavor"], "m1.small")
+        self.assertEqual(vms[0]["Updated"], "2024-01-02T00:00:00Z")
+        self.assertEqual(vms[1]["Image Name"], IMAGE_STRING_FOR_BFV)
+        # the details are kept for --bulk-details
+        self.assertEqual(session.server_details["vm1"]["tags"], ["keep"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from fedcloud_monitoring_tools.metrics import MetricsRegistry
+from fedcloud_monitoring_tools.serve import scan_site
+
+
+class FakeSiteMonitor:
+    """Site monitor without VMs that records the token of every call"""
+
+    def __init__(self, fail=None):
+        self.site = "SITE"
+        self.vo = "vo.example.org"
+        self.token = "old-token"
+        self.fail = fail
+        self.tokens = {}
+
+    def reset(self):
+        self.tokens["reset"] = self.token
+
+    def start_audits(self, show_quotas=True):
+        self.tokens["audits"] = self.token
+
+    def vm_monitor(self):
+        self.tokens["vms"] = self.token
+        if self.fail:
+            raise self.fail
+        return []
+
+    def show_quotas(self):
+        return {}
+
+    def check_unused_floating_ips(self):
+        return []
+
+    def check_unused_security_groups(self):
+        return []
+
+    def check_unused_volumes(self):
+        return []
+
+    def save_history(self, records, quota_info, floating_ips, volumes):
+        pass
+
+
+def scan_success(registry):
+    for name, labels, value in registry._samples[("SITE", "vo.example.org")]:
+        if name == "fedcloud_vo_monitor_scan_success":
+            return value
+
+
+class TestScanSite(unittest.TestCase):
+    def test_new_token_before_audits(self):
+        site_monitor = FakeSiteMonitor()
+        registry = MetricsRegistry()
+        error = scan_site(site_monitor, True, registry, lambda: "new-token")
+        self.assertIsNone(error)
+        self.assertEqual(
+            site_monitor.tokens,
+            {"reset": "new-token", "audits": "new-token", "vms": "new-token"},
+        )
+        self.assertEqual(scan_success(registry), 1)
+
+    def test_no_token(self):
+        def get_token():
+            raise SystemExit("Error: An access token is needed")
+
+        registry = MetricsRegistry()
+        error = scan_site(FakeSiteMonitor(), True, registry, get_token)
+        self.assertIn("access token", error)
+        self.assertEqual(scan_success(registry), 0)
+
+    def test_unexpected_error(self):
+        registry = MetricsRegistry()
+        scan_site(FakeSiteMonitor(), True, registry)
+        self.assertEqual(scan_success(registry), 1)
+        site_monitor = FakeSiteMonitor(fail=KeyError("ID"))
+        error = scan_site(site_monitor, True, registry)
+        self.assertEqual(error, "KeyError: 'ID'")
+        # the success of the previous scan is not served anymore
+        self.assertEqual(scan_success(registry), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()